@@ -1,21 +1,237 @@
+import collections
+import threading
 import time
 import serial
 
+START = b'/'
+END = b'\r'
+ETX = b'\x03'  # ends the data of a reply: /0 <status> <data> ETX \r\n
+READY = 0x20  # status bit 5: the valve is idle and accepts moves
+ERROR = 0x0F  # status bits 3..0: error code
+ERRORS = {0: 'no error', 1: 'initialization error', 2: 'invalid command', 3: 'invalid operand',
+          4: 'invalid command sequence', 6: 'EEPROM failure', 7: 'device not initialized', 10: 'valve overload',
+          15: 'command overflow'}
+CW, CCW = 'cw', 'ccw'  # rotation directions of the valve rotor, CW counts the ports up
+
+
+def rotation(start, port, ports=12):
+    """ returns the shortest rotation from start to port as signed number of port steps, > 0 is CW
+        half a turn goes CW
+    """
+    steps = (port - start) % ports
+    return steps if steps <= ports // 2 else steps - ports
+
+
+class Reply:
+    """ placeholder for the reply to a command sent to an ElveflowMux12
+        status and data are filled in by the reader thread of the MUX
+    """
+    __slots__ = ('cmd', 'status', 'data', 't', 'event')
+
+    def __init__(self, cmd):
+        self.cmd = cmd
+        self.status = None  # status byte, None until the reply arrived
+        self.data = None  # str, data of the reply
+        self.t = time.monotonic()  # time sent
+        self.event = threading.Event()
+
+    def wait(self, timeout=None):
+        """ blocks until the reply has arrived, returns False if timeout [s] has expired first
+        """
+        return self.event.wait(timeout)
+
+    @property
+    def busy(self):
+        return self.status is not None and not self.status & READY
+
+    @property
+    def error(self):
+        """ error code of the reply, see ERRORS, None until the reply arrived
+        """
+        return None if self.status is None else self.status & ERROR
+
+    def __repr__(self):
+        return f"{repr(self.cmd)[2:-1]:12}  {'-' if self.status is None else chr(self.status)}{self.data or ''}"
+
+
 class ElveflowMux12:
+    """
+    Elveflow MUX distributor or selector valve on a serial port
+    send() returns without waiting for the reply, which a reader thread per device assigns to the command
+    replies carry no command, so one command is in flight at a time: the next one is sent once the reply
+    has arrived, or has been given up after timeout and the input flushed, so a lost reply cannot shift
+    the replies of the following commands
+    the two valves are separate objects, each with its own reader thread, and work at the same time
+    moves are followed by Q status queries until the valve reports ready instead of waiting a fixed time
+    the rotor takes the shorter way round unless a direction is given, a move is estimated to take
+    t_switch + t_step per port passed (see move_time(), used by valve_planner)
+    """
 
-    def __init__(self, ser):
+    def __init__(self, ser, addr=b'1', timeout=1, interval=0.02, name=None, ports=12, cw=b'I', ccw=b'O',
+                 t_switch=0.2, t_step=0.1):
+        """
+        :param ser: serial.Serial object, e.g. serial.Serial(conf.port_selector, baudrate=115200)
+        :param addr: bytes, address of the valve
+        :param timeout: float, time [s] a reply is waited for
+        :param interval: float, time [s] between status queries while waiting for a move
+        :param name: str, used in error messages, the serial port by default
+        :param ports: int, number of ports of the valve
+        :param cw: bytes, command letter of a CW move, e.g. b'I' in I3R
+        :param ccw: bytes, command letter of a CCW move
+        :param t_switch: float, estimated time [s] of a move apart from the rotation
+        :param t_step: float, estimated time [s] the rotor takes from one port to the next
+        """
         self.ser = ser
-    def send_cmd(self, cmd, ADDR=b'1'):
-        START = b'/'
-        END = b'\r'
-        self.ser.write(START + ADDR + cmd + END)
-        print(f"{repr(cmd)[2:-1]:12}  {repr(self.ser.readline())[4:-5]}")
+        self.addr = addr
+        self.timeout = timeout
+        self.interval = interval
+        self.name = name or ser.port
+        self.ports = ports
+        self.letters = {CW: cw, CCW: ccw}
+        self.t_switch = t_switch
+        self.t_step = t_step
+        self.position = None  # port the valve was last moved to or reported, None if unknown
+        if ser.timeout is None:  # the reader thread has to be able to stop
+            ser.timeout = 0.1
+        self.lock = threading.Lock()  # serializes writes and the pending queue
+        self.pending = collections.deque()  # the Reply waiting for its reply, at most one, see send()
+        self.lost = 0  # replies not received within timeout
+        self._flushes = 0  # input flushes after lost replies, the reader drops its partial reply
+        self._running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
 
-    def port(self, port):
-        pass
+    def close(self):
+        """ ends the reader thread and closes the serial port
+        """
+        self._running = False
+        self.thread.join()
+        self.ser.close()
+
+    def _run(self):
+        buf = bytearray()
+        flushes = self._flushes
+        while self._running:
+            data = self.ser.read(self.ser.in_waiting or 1)
+            if flushes != self._flushes:
+                buf.clear()
+                flushes = self._flushes
+            if not data:
+                continue
+            buf += data
+            while True:
+                start = buf.find(b'/0')
+                end = buf.find(ETX, start + 2) if start >= 0 else -1
+                if end < 0:
+                    break
+                self._reply(buf[start + 2:end])
+                del buf[:end + 1]
+            if buf.find(b'/') < 0:
+                buf.clear()  # line ends and noise between replies
+
+    def _reply(self, frame):
+        with self.lock:
+            reply = self.pending.popleft() if self.pending else None
+        if reply is None:  # a late reply to a dropped command
+            return
+        reply.status = frame[0] if frame else 0
+        reply.data = frame[1:].decode(errors='replace')
+        reply.event.set()
+
+    def _drop(self):
+        # drops the commands that were never answered (e.g. garbled) and flushes the input, a late reply to
+        # them would otherwise be taken for the reply to the next command, call with self.lock held
+        now = time.monotonic()
+        lost = False
+        while self.pending and now - self.pending[0].t > self.timeout:
+            self.pending.popleft().event.set()
+            self.lost += 1
+            lost = True
+        if lost:
+            self.ser.reset_input_buffer()
+            self._flushes += 1
+
+    def send(self, cmd):
+        """ sends cmd, e.g. b'Q', and returns its Reply without waiting for it
+            while the previous command waits for its reply, cmd is sent after that reply or after timeout
+        """
+        reply = Reply(cmd)
+        while True:
+            with self.lock:
+                self._drop()
+                if not self.pending:
+                    reply.t = time.monotonic()
+                    self.pending.append(reply)
+                    self.ser.write(START + self.addr + cmd + END)
+                    return reply
+                last = self.pending[-1]
+            last.wait(self.timeout)
+
+    def send_cmd(self, cmd):
+        """ sends cmd and returns its Reply, raises TimeoutError if there is no reply
+        """
+        reply = self.send(cmd)
+        if not reply.wait(self.timeout) or reply.status is None:
+            raise TimeoutError(f'MUX {self.name}: no reply to {cmd}')
+        return reply
+
+    def _check(self, reply):
+        if reply.error:
+            raise RuntimeError(f'MUX {self.name}: {ERRORS.get(reply.error, reply.error)} ({reply.cmd})')
+        return reply
+
+    def status(self):
+        """ returns the Reply of a Q status query
+        """
+        return self._check(self.send_cmd(b'Q'))
 
     def busy(self):
-        pass
+        """ returns True while the valve is moving
+        """
+        return self.status().busy
+
+    def wait(self, timeout=None):
+        """ blocks until the valve is ready, returns False if timeout [s] has expired first
+        """
+        t = None if timeout is None else time.monotonic() + timeout
+        while self.busy():
+            if t is not None and time.monotonic() > t:
+                return False
+            time.sleep(self.interval)
+        return True
+
+    def move_time(self, start, port):
+        """ returns the estimated time [s] of the shortest move from start to port, 0 if they are the same
+        """
+        if start == port:
+            return 0
+        return self.t_switch + self.t_step * abs(rotation(start, port, self.ports))
+
+    def port(self, port=None, wait=True, timeout=10, direction=None):
+        """ moves the valve to port (1..ports) and returns the port
+            direction: CW, CCW or None for the shorter way round from the last known position,
+            which also skips a move to the port the valve is already at
+            wait=False returns right after the move has been accepted, see wait() and busy()
+            without port the current port is returned
+        """
+        if port is None:
+            data = self.send_cmd(b'?6').data
+            if data.isdigit():
+                self.position = int(data)
+                return self.position
+            return data
+        if direction is None and port == self.position:
+            return port
+        if direction is None:
+            if self.position is None:
+                self.port()
+            direction = CCW if type(self.position) is int and rotation(self.position, port, self.ports) < 0 else CW
+        self.position = None  # unknown until the move has been accepted
+        self._check(self.send_cmd(self.letters[direction] + b'%dR' % port))
+        self.position = port
+        if wait and not self.wait(timeout):
+            raise TimeoutError(f'MUX {self.name}: move to port {port} not finished after {timeout} s')
+        return port
 
 
 if __name__ == '__main__':
@@ -28,14 +244,23 @@ if __name__ == '__main__':
     '''mux.write(b'/1ZR\r')
     print(mux.readline())
     time.sleep(5)'''
-    s.send_cmd(b'O3R')
-    s.send_cmd(b'Q')
-    time.sleep(5)
-    s.send_cmd(b'Q')
-    s.send_cmd(b'O9R')
-    s.send_cmd(b'Q')
-    time.sleep(5)
-    s.send_cmd(b'Q')
-    s.send_cmd(b'?6')
-    s.send_cmd(b'?17')
-    time.sleep(5)
+    print(s.send_cmd(b'O3R'))
+    print(s.send_cmd(b'Q'))
+    t = time.monotonic()
+    s.wait()
+    print(f'move took {time.monotonic() - t:.2f} s')
+    print(s.send_cmd(b'Q'))
+    print(s.send_cmd(b'O9R'))
+    print(s.send_cmd(b'Q'))
+    s.wait()
+    print(s.send_cmd(b'Q'))
+    print(s.send_cmd(b'?6'))
+    print(s.send_cmd(b'?17'))
+
+    # both valves move at the same time
+    t = time.monotonic()
+    s.port(1, wait=False)
+    d.port(1, wait=False)
+    s.wait()
+    d.wait()
+    print(f'selector at {s.port()}, distributor at {d.port()} after {time.monotonic() - t:.2f} s')
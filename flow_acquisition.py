@@ -0,0 +1,176 @@
+'''
+background acquisition of the Sensirion SLF3S-1300F liquid flow sensor
+the sensor runs in continuous measurement mode and a thread writes timestamped flow and temperature
+samples into a preallocated NumPy ring buffer, readers copy from the buffer without taking a lock and
+without bus traffic
+'''
+import threading
+import time
+import numpy as np
+import i2c_bus
+
+ADDRESS = 0x08  # I2C address of the SLF3S
+CMD_START_H2O = b'\x36\x08'  # start continuous measurement, calibrated for water
+CMD_START_IPA = b'\x36\x15'  # start continuous measurement, calibrated for isopropyl alcohol
+CMD_STOP = b'\x3F\xF9'  # stop continuous measurement
+SCALE_FLOW = 500  # (ml/min)^-1, SLF3S-1300F
+SCALE_TEMP = 200  # °C^-1
+T_START = 0.012  # [s] until the first measurement is available after the start command
+
+T, FLOW, TEMP = 0, 1, 2  # columns of the ring buffer: time.monotonic() [s], flow [µL/min], temperature [°C]
+
+
+def crc8(data):
+    """ returns the Sensirion CRC-8 (polynomial 0x31, init 0xFF) of data
+    """
+    crc = 0xFF
+    for b in data:
+        crc ^= b
+        for _ in range(8):
+            crc = (crc << 1) ^ 0x31 if crc & 0x80 else crc << 1
+    return crc & 0xFF
+
+
+class FlowAcquisition:
+    """
+    samples the SLF3S continuously into a ring buffer of size samples
+    the writer stores a sample and then advances self.count, readers copy the samples they need and
+    check self.count again, so a reader never sees a sample being overwritten and never blocks the writer
+    flow() returns the latest flow, so the acquisition can stand in for mmplex_lib.FlowSensor
+    """
+
+    def __init__(self, i2c, size=65536, liquid='h2o', interval=0.0005, address=ADDRESS):
+        """
+        :param i2c: busio.I2C object, e.g. conf.i2c_flow_sensor, or its i2c_bus.I2CBus
+        :param size: int, number of samples kept
+        :param liquid: str, 'h2o' or 'ipa' calibration of the sensor
+        :param interval: float, time [s] between reads, the sensor updates every 0.5 ms
+        :param address: int, I2C address of the sensor
+        """
+        bus = i2c if isinstance(i2c, i2c_bus.I2CBus) else i2c_bus.I2CBus.get(i2c)
+        self.dev = bus.device(address, priority=i2c_bus.PRIORITY_POLL)
+        self.size = size
+        self.start_cmd = CMD_START_IPA if liquid == 'ipa' else CMD_START_H2O
+        self.interval = interval
+        self.address = address
+        self.buffer = np.full((size, 3), np.nan)
+        self.count = 0  # number of samples written so far, the next one goes to count % size
+        self.errors = 0  # reads with a CRC error
+        self.error = None  # the exception that ended the acquisition, if any
+        self._inbuf = bytearray(9)
+        self._running = False
+        self.thread = None
+
+    def _read(self):
+        self.dev.readinto(self._inbuf)
+        b = self._inbuf
+        if crc8(b[0:2]) != b[2] or crc8(b[3:5]) != b[5]:
+            self.errors += 1
+            return None
+        flow = int.from_bytes(b[0:2], 'big', signed=True) / SCALE_FLOW * 1000  # ml/min -> µL/min
+        temp = int.from_bytes(b[3:5], 'big', signed=True) / SCALE_TEMP
+        return flow, temp
+
+    def start(self):
+        """ starts continuous measurement and the acquisition thread
+        """
+        if self._running:
+            return
+        self.dev.write(self.start_cmd)
+        time.sleep(T_START)
+        self._running = True
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ ends the acquisition thread and stops continuous measurement
+        """
+        if not self._running:
+            return
+        self._running = False
+        self.thread.join()
+        self.dev.write(CMD_STOP)
+
+    def _run(self):
+        try:
+            while self._running:
+                sample = self._read()
+                if sample is not None:
+                    row = self.buffer[self.count % self.size]
+                    row[T] = time.monotonic()
+                    row[FLOW], row[TEMP] = sample
+                    self.count += 1
+                time.sleep(self.interval)
+        except Exception as e:
+            self.error = e
+            self._running = False
+
+    def last(self, n=1):
+        """ returns a copy of the last n samples, oldest first, as an array of shape (n, 3) (see T, FLOW, TEMP)
+            fewer if fewer have been taken, at most size - 1, as the slot after them may be being written
+        """
+        n = min(n, self.size - 1)
+        while True:
+            end = self.count
+            k = min(n, end)
+            idx = np.arange(end - k, end) % self.size
+            rows = self.buffer[idx]
+            # the writer is at most at the slot of the oldest row copied, unless the row was (being) overwritten
+            if self.count - end + k < self.size:
+                return rows
+
+    def _since(self, t0):
+        # number of the latest samples taken at or after t0, by bisection over the time column
+        end = self.count
+        lo, hi = end - min(end, self.size - 1), end
+        t = self.buffer[:, T]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if t[mid % self.size] < t0:
+                lo = mid + 1
+            else:
+                hi = mid
+        return end - lo
+
+    def _from(self, t0):
+        # copy of the samples taken at or after t0, oldest first
+        rows = self.last(self._since(t0) + 16)  # a few more in case samples were added meanwhile
+        return rows[rows[:, T] >= t0]
+
+    def window(self, seconds):
+        """ returns a copy of the samples of the last seconds [s], oldest first
+        """
+        return self._from(time.monotonic() - seconds)
+
+    def latest(self):
+        """ returns the latest sample (time, flow [µL/min], temperature [°C]) or None before the first one
+        """
+        rows = self.last(1)
+        return tuple(float(v) for v in rows[0]) if len(rows) else None
+
+    def flow(self):
+        """ returns the latest flow [µL/min], 0 before the first sample
+        """
+        s = self.latest()
+        return 0 if s is None else s[FLOW]
+
+    def stats(self, seconds):
+        """ returns the mean, standard deviation, minimum and maximum flow [µL/min] of the last seconds [s]
+            NaN if there are no samples
+        """
+        f = self.window(seconds)[:, FLOW]
+        if not len(f):
+            return np.nan, np.nan, np.nan, np.nan
+        return f.mean(), f.std(), f.min(), f.max()
+
+    def volume(self, t0, t1=None):
+        """ returns the volume [mL] integrated from the flow between the times t0 and t1 (time.monotonic(),
+            the latest sample if None), limited to the samples still in the buffer
+        """
+        rows = self._from(t0)
+        rows = rows[rows[:, T] <= (np.inf if t1 is None else t1)]
+        if len(rows) < 2:
+            return 0.0
+        f, t = rows[:, FLOW], rows[:, T]
+        return float(np.sum((f[1:] + f[:-1]) / 2 * np.diff(t)) / 60_000)  # µL/min * s -> mL
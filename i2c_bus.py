@@ -0,0 +1,309 @@
+'''
+manager of the I2C buses
+every bus is owned by one I2CBus that serializes the transactions of all threads through a priority queue,
+merges queued register writes to the same device and keeps NACK, retry and latency statistics per address
+devices are accessed through I2CBus.device(), which can be used like adafruit_bus_device.i2c_device.I2CDevice
+'''
+import threading
+import time
+
+# priorities of bus requests (lower goes first), like the ones of lis_circuitpython_tmc5130.Bus
+PRIORITY_SAFETY = 0  # safety stops
+PRIORITY_CONTROL = 1  # pump control
+PRIORITY_POLL = 2  # sensor reads and presence polling
+
+RETRIES = 3  # retries of a transaction the device did not acknowledge
+BACKOFF = 0.0005  # [s] wait before the first retry, doubled with every further one
+
+WRITE, READ, WRITE_READ, SCAN = 0, 1, 2, 3  # kinds of requests
+
+_buses = []  # all I2CBus objects created so far, see I2CBus.get()
+
+
+class _Request:
+    __slots__ = ('kind', 'address', 'out', 'inbuf', 'start', 'end', 'merge', 'retries', 'priority', 't', 'seq',
+                 'done', 'error', 'result', 'bus')
+
+    def __init__(self, bus, kind, address, out, inbuf, start, end, merge, retries, priority, seq):
+        self.bus = bus
+        self.kind = kind
+        self.address = address
+        self.out = out  # bytes to write, copied when submitted
+        self.inbuf = inbuf  # buffer to read into
+        self.start = start  # range of inbuf to read into
+        self.end = end
+        self.merge = merge  # out is a register address followed by data of an auto-incrementing register block
+        self.retries = retries
+        self.priority = priority
+        self.t = time.monotonic()
+        self.seq = seq
+        self.done = False
+        self.error = None
+        self.result = None
+
+    def wait(self):
+        """ blocks until the request has been served and returns its result, raises the OSError of a NACK
+        """
+        return self.bus._serve(self)
+
+
+def _merge(a, b):
+    # returns the write of register block a followed by b as one write, or None if the blocks do not touch
+    a0, b0 = a[0], b[0]
+    a1, b1 = a0 + len(a) - 1, b0 + len(b) - 1
+    if b0 > a1 or a0 > b1:
+        return None
+    lo = min(a0, b0)
+    block = bytearray(max(a1, b1) - lo + 1)
+    block[0] = lo
+    block[a0 - lo + 1:a1 - lo + 1] = a[1:]
+    block[b0 - lo + 1:b1 - lo + 1] = b[1:]
+    return bytes(block)
+
+
+class I2CBus:
+    """
+    arbitrates an I2C bus between the threads using it
+    requests are queued by priority (PRIORITY_SAFETY before PRIORITY_CONTROL before PRIORITY_POLL),
+    first come first served within a priority, and waiting requests gain one priority level per aging seconds
+    the thread that finds the bus idle runs the queued requests of all threads until its own is done,
+    the others wait on a condition instead of spinning on try_lock()
+    a register write to a device that opted in (see device()) is merged into the write queued just before
+    it for the same device when their register ranges touch, so the device gets one burst instead of two
+    self.stats holds per address: transactions, nacks, retries, failures, merged, busy (time on the bus [s]),
+    latency (time from submission to completion [s]) and max_latency
+    """
+
+    def __init__(self, i2c, retries=RETRIES, backoff=BACKOFF, aging=0.1):
+        """
+        :param i2c: busio.I2C or ExtendedI2C object, e.g. conf.i2c_chambers
+        :param retries: int, retries of a transaction that was not acknowledged
+        :param backoff: float, wait [s] before the first retry, doubled with every further one
+        :param aging: float, waiting time [s] per priority level gained
+        """
+        self.i2c = i2c
+        self.retries = retries
+        self.backoff = backoff
+        self.aging = aging
+        self.cv = threading.Condition()  # protects the queue and the statistics
+        self.queue = []
+        self.seq = 0
+        self.running = False
+        self.stats = {}
+
+    @classmethod
+    def get(cls, i2c):
+        """ returns the I2CBus of i2c, creating it on first use
+        """
+        for b in _buses:
+            if b.i2c is i2c:
+                return b
+        b = cls(i2c)
+        _buses.append(b)
+        return b
+
+    def device(self, address, priority=PRIORITY_CONTROL, merge=False, retries=None):
+        """ returns a Device proxy for address
+            merge=True declares the device's writes as register address + data of an auto-incrementing
+            register block, so queued writes may be merged
+            retries: retries of the device's transactions, self.retries if None, e.g. 0 for a device whose
+            driver retries on its own
+        """
+        return Device(self, address, priority, merge, retries)
+
+    def submit(self, kind, address=None, out=None, inbuf=None, start=0, end=None, merge=False, retries=None,
+               priority=PRIORITY_CONTROL):
+        """ queues a request and returns it, the request is served at the latest when waited for
+        """
+        with self.cv:
+            if merge and kind == WRITE and out:
+                last = next((q for q in reversed(self.queue) if q.address == address), None)
+                if last is not None and last.kind == WRITE and last.merge:
+                    merged = _merge(last.out, out)
+                    if merged is not None:
+                        last.out = merged
+                        last.priority = min(last.priority, priority)
+                        self._stat(address)['merged'] += 1
+                        return last
+            req = _Request(self, kind, address, out, inbuf, start, end, merge,
+                           self.retries if retries is None else retries, priority, self.seq)
+            self.seq += 1
+            self.queue.append(req)
+            return req
+
+    def write(self, address, buf, merge=False, priority=PRIORITY_CONTROL):
+        """ writes buf to address
+        """
+        self.submit(WRITE, address, bytes(buf), merge=merge, priority=priority).wait()
+
+    def readinto(self, address, buf, start=0, end=None, priority=PRIORITY_CONTROL):
+        """ reads from address into buf[start:end]
+        """
+        self.submit(READ, address, inbuf=buf, start=start, end=end, priority=priority).wait()
+
+    def write_then_readinto(self, address, out, buf, start=0, end=None, priority=PRIORITY_CONTROL):
+        """ writes out to address and reads into buf[start:end] after a repeated start
+        """
+        self.submit(WRITE_READ, address, bytes(out), buf, start, end, priority=priority).wait()
+
+    def probe(self, address, priority=PRIORITY_POLL):
+        """ returns True if a device acknowledges a zero length write to address, without retries
+        """
+        try:
+            self.submit(WRITE, address, b'', retries=0, priority=priority).wait()
+        except OSError:
+            return False
+        return True
+
+    def scan(self, priority=PRIORITY_POLL):
+        """ returns the addresses of the devices on the bus
+        """
+        return self.submit(SCAN, priority=priority).wait()
+
+    def _stat(self, address):
+        s = self.stats.get(address)
+        if s is None:
+            s = self.stats[address] = dict(transactions=0, nacks=0, retries=0, failures=0, merged=0,
+                                           busy=0.0, latency=0.0, max_latency=0.0)
+        return s
+
+    def report(self):
+        """ returns the statistics as text, one line per address, the address taking most bus time first
+        """
+        with self.cv:
+            stats = sorted(self.stats.items(), key=lambda a_s: -a_s[1]['busy'])
+            lines = []
+            for a, s in stats:
+                n = max(s['transactions'], 1)
+                lines.append(f"{a:#04x}: {s['transactions']} transactions, {s['nacks']} NACKs, {s['retries']} retries, "
+                             f"{s['failures']} failed, {s['merged']} merged, bus {s['busy'] / n * 1e3:.3f} ms, "
+                             f"latency {s['latency'] / n * 1e3:.3f} ms (max {s['max_latency'] * 1e3:.3f} ms)")
+        return '\n'.join(lines)
+
+    def _transfer(self, q):
+        i2c = self.i2c
+        if q.kind == WRITE:
+            i2c.writeto(q.address, q.out)
+        elif q.kind == READ:
+            i2c.readfrom_into(q.address, q.inbuf, start=q.start, end=len(q.inbuf) if q.end is None else q.end)
+        elif q.kind == WRITE_READ:
+            i2c.writeto_then_readfrom(q.address, q.out, q.inbuf, in_start=q.start,
+                                      in_end=len(q.inbuf) if q.end is None else q.end)
+        else:
+            return i2c.scan()
+
+    def _execute(self, q):
+        t0 = time.monotonic()
+        backoff = self.backoff
+        nacks = 0
+        for attempt in range(q.retries + 1):
+            try:
+                q.result = self._transfer(q)
+                q.error = None
+                break
+            except OSError as e:
+                q.error = e
+                nacks += 1
+                if attempt < q.retries:
+                    time.sleep(backoff)
+                    backoff *= 2
+        if q.address is None:
+            return
+        t = time.monotonic()
+        with self.cv:
+            s = self._stat(q.address)
+            s['transactions'] += 1
+            s['nacks'] += nacks
+            s['retries'] += min(nacks, q.retries)
+            s['failures'] += q.error is not None
+            s['busy'] += t - t0
+            s['latency'] += t - q.t
+            s['max_latency'] = max(s['max_latency'], t - q.t)
+
+    def _serve(self, req):
+        with self.cv:
+            while self.running and not req.done:
+                self.cv.wait()
+            runner = not req.done
+            self.running |= runner
+        if runner:
+            try:
+                while not self.i2c.try_lock():  # only contended by users bypassing the manager
+                    time.sleep(0)
+                try:
+                    while not req.done:
+                        with self.cv:
+                            now = time.monotonic()
+                            nxt = min(self.queue, key=lambda q: (q.priority - (now - q.t) / self.aging, q.seq))
+                            self.queue.remove(nxt)  # a running request takes no more merges
+                        self._execute(nxt)
+                        with self.cv:
+                            nxt.done = True
+                            self.cv.notify_all()
+                finally:
+                    self.i2c.unlock()
+            finally:
+                with self.cv:
+                    self.running = False
+                    self.cv.notify_all()
+        if req.error:
+            raise req.error
+        return req.result
+
+
+class Device:
+    """
+    proxy of a device on an I2CBus, usable like adafruit_bus_device.i2c_device.I2CDevice:
+        with device as d:
+            d.write(buf)
+    every access is one queued transaction, `with` does not hold the bus
+    """
+
+    def __init__(self, bus, address, priority=PRIORITY_CONTROL, merge=False, retries=None):
+        """
+        :param bus: I2CBus object
+        :param address: int, I2C address of the device
+        :param priority: int, priority of the device's requests, e.g. PRIORITY_POLL for sensors
+        :param merge: bool, the writes are register address + data of an auto-incrementing register block
+        :param retries: int, retries of a transaction that was not acknowledged, those of the bus if None
+        """
+        self.bus = bus
+        self.device_address = address
+        self.priority = priority
+        self.merge = merge
+        self.retries = retries
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    def write(self, buf, start=0, end=None):
+        """ writes buf[start:end] to the device
+        """
+        self.bus.submit(WRITE, self.device_address, bytes(buf[start:end]), merge=self.merge,
+                        retries=self.retries, priority=self.priority).wait()
+
+    def readinto(self, buf, start=0, end=None):
+        """ reads from the device into buf[start:end]
+        """
+        self.bus.submit(READ, self.device_address, inbuf=buf, start=start, end=end, retries=self.retries,
+                        priority=self.priority).wait()
+
+    def write_then_readinto(self, out_buffer, in_buffer, out_start=0, out_end=None, in_start=0, in_end=None):
+        """ writes out_buffer[out_start:out_end] and reads into in_buffer[in_start:in_end] after a repeated start
+        """
+        self.bus.submit(WRITE_READ, self.device_address, bytes(out_buffer[out_start:out_end]), in_buffer,
+                        in_start, in_end, retries=self.retries, priority=self.priority).wait()
+
+    def probe(self):
+        """ returns True if the device acknowledges a zero length write
+        """
+        return self.bus.probe(self.device_address, self.priority)
+
+    def stats(self):
+        """ returns a copy of the statistics of the device's address
+        """
+        with self.bus.cv:
+            return dict(self.bus._stat(self.device_address))
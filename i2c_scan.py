@@ -1,5 +1,6 @@
 import time
 import conf
+import i2c_bus
 
 i2c = conf.i2c_chambers  # uses board.SCL and board.SDA
 # i2c = board.STEMMA_I2C()  # For using the built-in STEMMA QT connector on a microcontroller
@@ -9,16 +10,15 @@ i2c = conf.i2c_chambers  # uses board.SCL and board.SDA
 # i2c = busio.I2C(board.SCL1, board.SDA1)  # QT Py RP2040 STEMMA connector
 # i2c = busio.I2C(board.GP1, board.GP0)    # Pi Pico RP2040
 
-while not i2c.try_lock():
-    pass
+bus = i2c_bus.I2CBus.get(i2c)  # the scans are queued with the transactions of other threads on the bus
 
-try:
-    while True:
-        print(
-            "I2C addresses found:",
-            [hex(device_address) for device_address in i2c.scan()],
-        )
-        time.sleep(2)
-
-finally:  # unlock the i2c bus when ctrl-c'ing out of the loop
-    i2c.unlock()
\ No newline at end of file
+while True:
+    found = bus.scan()
+    print(
+        "I2C addresses found:",
+        [hex(device_address) for device_address in found],
+    )
+    # zero length probes of the chamber piezo pumps, counted in the per address statistics
+    print("chambers present:", [c for c, a in conf.chambers_adresses.items() if bus.probe(a)])
+    print(bus.report())
+    time.sleep(2)
@@ -15,6 +15,9 @@ I2C_P4VOLTAGE = 0x09
 I2C_UPDATEVOLTAGE = 0x0A
 I2C_AUDIO = 0x05
 
+# register block 0x01..0x0A written at init: power on, 100Hz, sine wave, 800kHz boost, audio off, amplitudes 0
+BLOCK_DEFAULT = bytes([0x01, 0x80, 0x00, 0x00, 0x00, 0, 0, 0, 0])  # 0x01..0x09, 0x0A (update) is written as 0x01
+
 class MP6_HD:
 
     def __init__(self, i2c, base_addr=0x78, device_addr=None, i2c_addr=0x78):
@@ -97,6 +100,123 @@ class MP6_HD:
             print('read back failed')
 
 
+class MP6_HDs:
+    """
+    the MP6_HD piezo pump drivers of several chambers on one I2C bus
+    the settings are staged with the set_...() methods and written by update(): for every driver only the bytes
+    from the first changed register on are written, as one burst that ends with the update register
+    self.shadow holds what was last written to each driver, so unchanged drivers cost no transaction
+    a driver that does not acknowledge any attempt of update() is marked absent and skipped until probe()
+    finds it again, e.g. when a chamber is inserted (see chamber_presence)
+    """
+
+    def __init__(self, i2c, addresses=(0x78, 0x79, 0x7A, 0x7B), retries=5, backoff=0.001):
+        """
+        :param i2c: busio.I2C object, or an i2c_bus.I2CBus to share the bus with other threads
+        :param addresses: I2C addresses of the drivers, e.g. conf.chambers_adresses.values()
+        :param retries: int, attempts per driver and update() after a NACK, the bus manager does not retry
+                        on top of them
+        :param backoff: float, wait [s] after the first NACK, doubled with every further one
+        initializes all drivers with BLOCK_DEFAULT
+        """
+        self.addresses = tuple(addresses)
+        if hasattr(i2c, 'device'):  # i2c_bus.I2CBus, the bursts are register blocks and may be merged
+            self.devs = {a: i2c.device(a, merge=True, retries=0) for a in self.addresses}
+        else:
+            self.devs = {a: i2c_device.I2CDevice(i2c, a, probe=False) for a in self.addresses}
+        self.retries = retries
+        self.backoff = backoff
+        self.shadow = {a: None for a in self.addresses}  # registers 0x01..0x09 last written, None if unknown
+        self.staged = {a: bytearray(BLOCK_DEFAULT) for a in self.addresses}  # registers 0x01..0x09 to write
+        self.absent = set()  # addresses of drivers that did not acknowledge, skipped by update()
+        self.update()
+
+    def _stage(self, reg, values, addresses):
+        # values: one value for all addresses or a dict {address: value}
+        for a in self.addresses if addresses is None else addresses:
+            v = values.get(a) if type(values) is dict else values
+            if v is not None:
+                self.staged[a][reg - I2C_POWERMODE] = v
+
+    def set_amp(self, amp, addresses=None, channel=4, ramp=0b001):
+        """ stages the amplitude (0..31) of a channel (1..4), amp is a number or a dict {address: amp}
+            b7-5 of the voltage register: ramp time
+        """
+        if type(amp) is dict:
+            amp = {a: ramp << 5 | v for a, v in amp.items()}
+        else:
+            amp = ramp << 5 | amp
+        self._stage(I2C_PVOLTAGE + channel - 1, amp, addresses)
+
+    def set_freq(self, f, addresses=None):
+        """ stages the frequency byte (0x40: 100Hz), f is a number or a dict {address: f}
+        """
+        self._stage(I2C_FREQUENCY, f, addresses)
+
+    def set_shape(self, val, addresses=None):
+        """ stages the wave shape, b0-1:shape  b2-5:0  b6:damp  b7:0
+        """
+        self._stage(I2C_SHAPE, val, addresses)
+
+    def powermode(self, en, addresses=None):
+        """ stages the power mode, 1: enable, 0: disable
+        """
+        self._stage(I2C_POWERMODE, en, addresses)
+
+    def probe(self, addresses=None):
+        """ checks with a zero length write, without retries, which drivers acknowledge
+            a driver found is no longer absent and gets all staged registers with the next update()
+            returns the addresses of the drivers found
+        """
+        found = []
+        for a in self.addresses if addresses is None else tuple(addresses):  # may be self.absent
+            try:
+                with self.devs[a] as d:
+                    d.write(b'')
+            except OSError:
+                self.absent.add(a)
+                continue
+            if a in self.absent:
+                self.absent.discard(a)
+                self.shadow[a] = None
+            found.append(a)
+        return found
+
+    def update(self):
+        """ writes the staged settings to all drivers that differ from their shadow in a single pass
+            a driver that does not acknowledge is retried after a growing backoff, and marked absent if it
+            never does, absent drivers are skipped until probe() finds them
+            returns the addresses of the drivers that could not be written, including the absent ones,
+            their shadow is invalidated
+        """
+        pending = {}
+        for a in self.addresses:
+            if a in self.absent:
+                continue
+            staged, shadow = self.staged[a], self.shadow[a]
+            first = 0 if shadow is None else next((i for i in range(len(staged)) if staged[i] != shadow[i]), None)
+            if first is not None:
+                pending[a] = bytes([I2C_POWERMODE + first]) + staged[first:] + b'\x01'  # ... I2C_UPDATEVOLTAGE
+        backoff = self.backoff
+        for attempt in range(self.retries):
+            for a in list(pending):
+                try:
+                    with self.devs[a] as d:
+                        d.write(pending[a])
+                except OSError:
+                    continue
+                self.shadow[a] = bytes(self.staged[a])
+                del pending[a]
+            if not pending:
+                break
+            time.sleep(backoff)
+            backoff *= 2
+        for a in pending:
+            self.shadow[a] = None
+        self.absent.update(pending)
+        return [a for a in self.addresses if a in self.absent]
+
+
 '''Wire.beginTransmission(I2C_HIGHDRIVER_ADRESS);
 Wire.write(I2C_POWERMODE); // Start Register 0x01
 Wire.write(0x01); // Register 0x01 = 0x01 (enable)
@@ -123,70 +243,35 @@ nPumpVoltageByte[3] = 0x1F;'''
 if __name__ == '__main__':
     print('testing mp6 driver...')
 
-import board
-import busio
+    import board
+    import busio
 
-max_retries = 1_000
+    i2c = busio.I2C(board.SCL, board.SDA, frequency=400_000)
 
-i2c = busio.I2C(board.SCL, board.SDA, frequency=400_000)
+    # update() retries a driver that does not acknowledge with a bounded backoff (5 attempts, 31 ms in total)
+    # and skips it afterwards until probe() finds it
+    max = MP6_HDs(i2c, addresses=(0x78,))
+    if 0x78 in max.absent:
+        print('driver 0x78 does not acknowledge')
 
-
-for _ in range(max_retries):
     try:
-        max = MP6_HD(i2c, i2c_addr=0x78)
-        max.settings()
-        break
-    except OSError:
-        pass
-
-try:
-    while True:
-        inp = input('enter power level 0-31? ')
-        print(inp)
-        if inp[0] == 'f':
-            a = None
-            f = int(inp[1:])
-            s = None
-        elif inp[0] == 's':
-            a = None
-            f = None
-            s = int(inp[1:])
-        else:
-            f = None
-            a = int(inp)
-            s = None
-        for tries in range(max_retries):
-            try:
-                #max.powermode(0)
-                #time.sleep(0.002)
-                if a is not None:
-                    max.set_amp(0b011_00000 | a)
-                if f is not None:
-                    max.set_freq(f)
-                if s is not None:
-                    max.set_shape(s)
-                #time.sleep(0.001)
-                #max.powermode(1)
-            except OSError:
-                time.sleep(0.01)
-                pass
+        while True:
+            inp = input('enter power level 0-31? ')
+            print(inp)
+            if inp[0] == 'f':
+                max.set_freq(int(inp[1:]))
+            elif inp[0] == 's':
+                max.set_shape(int(inp[1:]))
             else:
-                break
-        else:
-            print('too many tries')
-        print('tries: ', tries)
-
+                max.set_amp(int(inp), ramp=0b011)
+            max.probe(max.absent)
+            failed = max.update()
+            if failed:
+                print('not written to', [hex(a) for a in failed])
 
-finally:
-    print('shut down')
-    while True:
-        try:
-            max.powermode(0)
-        except (OSError, AttributeError):
-            time.sleep(0.1)
-        else:
-            break
+    finally:
+        print('shut down')
+        max.powermode(0)
+        if max.update():
+            print('driver 0x78 could not be shut down')
         sys.exit()
-
-
-
@@ -1,9 +1,21 @@
 from micropython import const
+import asyncio
+import json
+import os
 import struct
+import threading
+import time
+import tmc5130_ramp as ramp
+try:
+    import RPi.GPIO as GPIO  # edge detection on SWP_DIAG1 for Strobe, polled if not available
+except ImportError:
+    GPIO = None
 
 DEBUG = False
 
 PKTLEN = const(5) # packet length
+DATAGRAM = struct.Struct('>BL')  # status or address byte and 32 bit data
+DATAGRAM_SIGNED = struct.Struct('>Bl')
 
 GSTAT = const(0x01)  # Global status flags
 GCONF = const(0x00)  # General Configuration Registers
@@ -17,6 +29,11 @@ OUTPUT = const(0x04) # NAO output for UART configuration (see manual)
 X_COMPARE = const(0x05)  # Position comparison register for motion controller position strobe.
     # The Position pulse is available on output SWP_DIAG1
 CHOPCONF = const(0x6C)
+COOLCONF = const(0x6D)  # CoolStep smart current control and StallGuard2 configuration (write only)
+DRV_STATUS = const(0x6F)  # StallGuard2 value, driver error flags and the active chopper mode (read only)
+    # 9..0 SG_RESULT | 14 stealth | 24 CS_ACTUAL 20..16 | 25 otpw | 26 ot | 28..27 s2g | 30..29 ol | 31 stst
+PWMCONF = const(0x70)  # StealthChop voltage PWM mode configuration (write only)
+    # 7..0 PWM_AMPL | 15..8 PWM_GRAD | 17..16 pwm_freq | 18 pwm_autoscale | 19 pwm_symmetric | 21..20 freewheel
 IHOLD_IRUN = const(0x10)  # b19..16 IHOLDDELAY | b12..0 IRUN | b4..0 IHOLD
     # IHOLDDELAY Controls the number of clock cycles for motor power down after a motion as soon as standstill is
     # detected (stst=1) and TPOWERDOWN has expired. The smooth transition avoids a motor jerk upon power down.
@@ -30,7 +47,10 @@ TPOWERDOWN = const(0x11)  # 8b TPOWERDOWN sets the delay time after stand still
     # power down. Time range is about 0 to 4 seconds.
         #0: no delay, 1: minimum delay,
         #2..255: (TPOWERDOWN-1) * 2^18 tCLK
-TPWMTHRS = const(0x13)  # upper velocity limit for StealthChop
+TSTEP = const(0x12)  # 20b actual time between two 1/256 microsteps in units of 1/fCLK (read only)
+TPWMTHRS = const(0x13)  # 20b upper velocity limit for StealthChop: StealthChop is used while TSTEP >= TPWMTHRS
+TCOOLTHRS = const(0x14)  # 20b lower velocity limit for CoolStep and the StallGuard2 output (TSTEP <= TCOOLTHRS)
+THIGH = const(0x15)  # 20b velocity limit for the high velocity chopper mode and fullstep (TSTEP <= THIGH)
 RAMPMODE = const(0x20)  # 0: Position, 1: Right Turn, 2: Left Turn
 XACTUAL = const(0x21)
 VACTUAL = const(0x22)
@@ -51,76 +71,1074 @@ SW_MODE = const(0x34)  # Reference Switch & StallGuard2 Event Configuration Regi
 RAMP_STAT = const(0x35)  # Ramp & Reference Switch Status Register
 XLATCH = const(0x36)  # 32b Ramp generator latch position, latches XACTUAL upon a programmable switch event (see SW_MODE).
 
+RAMP_STAT_EVENTS = const(0x10CC)  # RAMP_STAT bits cleared upon read: status_latch_l/r, event_stop_sg, event_pos_reached, second_move
+
+RAMP_REGS = {VSTART: 'vstart', A1: 'a1', V1: 'v1', AMAX: 'amax', VMAX: 'vmax', DMAX: 'dmax', D1: 'd1', VSTOP: 'vstop'}
+
+# configuration and write-only registers that only change when written, see Chain.shadow
+SHADOW_REGS = (GCONF, IHOLD_IRUN, TPOWERDOWN, TPWMTHRS, TCOOLTHRS, THIGH, RAMPMODE, VSTART, A1, V1, AMAX, VMAX,
+               DMAX, D1, VSTOP, TZEROWAIT, X_COMPARE, SW_MODE, CHOPCONF, COOLCONF, PWMCONF)
+
+READABLE_REGS = (GCONF, RAMPMODE, SW_MODE, CHOPCONF)  # shadowed registers that can be read back for verification
+
+GCONF_EN_PWM_MODE = const(0x04)  # GCONF b2: StealthChop below the TPWMTHRS velocity
+GCONF_DIAG1_POSCOMP_PUSHPULL = const(0x2000)  # GCONF b13: SWP_DIAG1 push pull, active high (X_COMPARE pulse)
+
+
+def tstep(rps, steps=200, fclk=13e6):
+    """ converts a velocity [rotations/s] into TSTEP units, the time between two 1/256 microsteps [1/fclk],
+        as compared with the velocity thresholds TPWMTHRS, TCOOLTHRS and THIGH (faster is smaller)
+        the result does not depend on the microstep resolution
+        rps=None or 0 returns 0, which puts the threshold at infinite velocity
+    """
+    if not rps:
+        return 0
+    return min(int(fclk / (abs(rps) * steps * 256)), 0xF_FFFF)
+
+
+def rps(tstep, steps=200, fclk=13e6):
+    """ converts TSTEP units into a velocity [rotations/s], see tstep()
+    """
+    return fclk / (tstep * steps * 256) if tstep else 0
+
+
+# register images for Chain.configure(), applied in this order
+PROFILE_DEFAULT = {
+    GCONF: 0x00,
+    CHOPCONF: 0x000100C5,  # TOFF=5, HSTRT=4, HEND=1, TBL=2, CHM=0 (spreadCycle)
+    IHOLD_IRUN: 0x011705,  # IHOLD=0x04, IRUN=0x17, IHOLDDELAY=1
+    TPWMTHRS: 0,  # upper velocity for StealthChop
+    A1: 1000,
+    V1: 5000,
+    AMAX: 5000,
+    VMAX: 20000,
+    DMAX: 5000,
+    D1: 5000,
+    VSTOP: 10,
+    SW_MODE: 0,
+    RAMPMODE: 0,  # Target position move
+}
+
+PROFILES = {
+    'default': PROFILE_DEFAULT,
+    # chamber tilt motors on the dock chain with a left reference switch
+    # quiet StealthChop while tilting slowly, spreadCycle for faster moves that would stall in StealthChop
+    'dock-tilt': {
+        **PROFILE_DEFAULT,
+        GCONF: 0b110,  # b2=stealthchop, b1=internal sense resistors
+        # TOFF=3 instead of the default TOFF=5 (shorter slow decay, as in the datasheet's StealthChop example)
+        CHOPCONF: 0x000100C3,  # TOFF=3, HSTRT=4, HEND=1, TBL=2, CHM=0 (spreadCycle above TPWMTHRS)
+        PWMCONF: 0x000401C8,  # PWM_AMPL=200, PWM_GRAD=1, pwm_freq=2/1024 fCLK, pwm_autoscale
+        TPWMTHRS: tstep(1.0),  # StealthChop up to 1 rps
+        THIGH: 0,  # no fullstep mode
+        IHOLD_IRUN: 0x01_10_00,  # IHOLDDELAY=1, IRUN=(16+1)/32 IHOLD=(0+1)/32
+        AMAX: 2000,
+        DMAX: 1000,
+        # b11 soft stop, b05 latch_l_active, b02 pol_stop_l, b00 stop_l_enable
+        SW_MODE: 0b1000_0010_0101,
+    },
+    # syringe pump motor on the pump chain
+    # StealthChop for slow dispensing, spreadCycle from 1 rps for fast filling and emptying
+    'syringe-pump': {
+        **PROFILE_DEFAULT,
+        GCONF: 0b100,  # b2=stealthchop
+        # TOFF=3 instead of the default TOFF=5 (shorter slow decay, as in the datasheet's StealthChop example)
+        CHOPCONF: 0x000100C3,  # TOFF=3, HSTRT=4, HEND=1, TBL=2, CHM=0 (spreadCycle above TPWMTHRS)
+        PWMCONF: 0x000401C8,  # PWM_AMPL=200, PWM_GRAD=1, pwm_freq=2/1024 fCLK, pwm_autoscale
+        TPWMTHRS: tstep(1.0),  # StealthChop up to 1 rps
+        IHOLD_IRUN: 0x01_10_06,  # IHOLDDELAY=1, IRUN=(16+1)/32 IHOLD=(6+1)/32
+        VMAX: 130_000,  # ~2 rps with 200 steps/round, reachable in spreadCycle
+    },
+}
+
+
+def compile_profile(profile, **regs):
+    """ returns the register image of a profile as a list of (regnum, val) in write order
+            profile: name in PROFILES or a dict {regnum: val}
+            regs: overrides by register name, e.g. GCONF=0b110
+    """
+    image = dict(PROFILES[profile] if type(profile) is str else profile)
+    for name, val in regs.items():
+        image[globals()[name]] = val
+    order = tuple(PROFILE_DEFAULT)
+    last = order.index(RAMPMODE) - 0.5  # other registers go before RAMPMODE
+    return sorted(image.items(), key=lambda rv: order.index(rv[0]) if rv[0] in order else last)
+
+# priorities of bus requests (lower goes first), see Bus
+PRIORITY_SAFETY = const(0)  # safety stops
+PRIORITY_CONTROL = const(1)  # motion and pump control
+PRIORITY_POLL = const(2)  # status polling
+
+SNAPSHOT_MAX_AGE = 0.005  # [s] default time a Chain.snapshot() is reused by the status accessors
+
+BAUDRATE_DEFAULT = 100_000  # used when no characterized baudrate is stored for a chain
+BAUDRATES = (100_000, 250_000, 500_000, 1_000_000, 2_000_000, 4_000_000)  # tried by Chain.characterize()
+BAUDRATE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tmc5130_baudrates.json')
+
+RETRIES = const(3)  # retransmissions of a write whose echo does not match before the drive is marked as failed
+
+_chains = []  # all Chain objects created so far, see Chain.get()
+_buses = []  # all Bus objects created so far, see Bus.get()
+
+
+def load_baudrate(name, phase=1, polarity=1, default=BAUDRATE_DEFAULT, path=BAUDRATE_FILE):
+    """ returns the baudrate stored by Chain.characterize() for the chain name and SPI mode
+        or default if there is none
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)[name][f'{phase}{polarity}']
+    except (OSError, ValueError, KeyError, TypeError):
+        return default
+
+
+def save_baudrate(name, phase, polarity, baudrate, path=BAUDRATE_FILE):
+    """ stores the baudrate of the chain name and SPI mode, keeping the other entries
+    """
+    try:
+        with open(path) as f:
+            rates = json.load(f)
+    except (OSError, ValueError):
+        rates = {}
+    rates.setdefault(name, {})[f'{phase}{polarity}'] = baudrate
+    with open(path, 'w') as f:
+        json.dump(rates, f, indent=2)
+
+
+class _Request:
+    __slots__ = ('chain', 'priority', 'echo', 'ticket', 't', 'seq', 'done', 'error', 'transfers')
+
+    def __init__(self, chain, priority, echo, ticket, seq):
+        self.chain = chain
+        self.priority = priority
+        self.echo = echo
+        self.ticket = ticket  # number of accesses submitted to the chain that the request waits for
+        self.t = time.monotonic()
+        self.seq = seq
+        self.done = False
+        self.error = None
+        self.transfers = 0
+
+
+class Bus:
+    """
+    arbitrates an SPI bus between the chains on it and between threads
+    flush requests are queued by priority (PRIORITY_SAFETY before PRIORITY_CONTROL before PRIORITY_POLL),
+    first come first served within a priority, and waiting requests gain one priority level per
+    aging seconds so polling is never starved
+    the thread that finds the bus idle runs the queued requests of all threads until its own is done,
+    requests for the same chain are served by one flush, so their accesses share frames
+    spi.configure() is only called when phase, polarity or baudrate change
+    """
+
+    def __init__(self, spi, aging=0.1):
+        """
+        :param spi: busio.SPI object
+        :param aging: float, waiting time [s] per priority level gained
+        """
+        self.spi = spi
+        self.aging = aging
+        self.lock = threading.RLock()  # held while the bus is used
+        self.owner = None  # thread holding self.lock
+        self.depth = 0
+        self.cv = threading.Condition()  # protects the queue
+        self.queue = []
+        self.seq = 0
+        self.running = False
+        self.config = None  # (phase, polarity, baudrate) last configured
+
+    @classmethod
+    def get(cls, spi):
+        """ returns the Bus of spi, creating it on first use
+        """
+        for b in _buses:
+            if b.spi is spi:
+                return b
+        b = cls(spi)
+        _buses.append(b)
+        return b
+
+    def acquire(self, phase, polarity, baudrate):
+        """ takes exclusive use of the bus (reentrant) and configures it if necessary
+        """
+        self.lock.acquire()
+        if not self.depth:
+            while not self.spi.try_lock():
+                time.sleep(0)
+        self.owner = threading.get_ident()
+        self.depth += 1
+        if self.config != (phase, polarity, baudrate):
+            self.spi.configure(phase=phase, polarity=polarity, baudrate=baudrate)
+            self.config = (phase, polarity, baudrate)
+
+    def release(self):
+        self.depth -= 1
+        if not self.depth:
+            self.owner = None
+            self.spi.unlock()
+        self.lock.release()
+
+    def transact(self, chain, priority=PRIORITY_POLL, echo=True):
+        """ flushes the accesses submitted to chain so far and returns the number of transfers
+            blocks until they have been sent, by this thread or the one currently running the bus
+        """
+        if self.owner == threading.get_ident():  # inside `with chain:`, the bus is ours
+            with chain:
+                return chain._flush(echo)
+        with self.cv:
+            req = _Request(chain, priority, echo, chain.submitted, self.seq)
+            self.seq += 1
+            self.queue.append(req)
+            while self.running and not req.done:
+                self.cv.wait()
+            if req.done:
+                if req.error:
+                    raise req.error
+                return req.transfers
+            self.running = True
+        try:
+            while not req.done:
+                with self.cv:
+                    now = time.monotonic()
+                    nxt = min(self.queue, key=lambda q: (q.priority - (now - q.t) / self.aging, q.seq))
+                c = nxt.chain
+                try:
+                    with c:
+                        n = c._flush(nxt.echo)
+                    error = None
+                except Exception as e:
+                    n, error = 0, e
+                with self.cv:
+                    for q in self.queue:
+                        if q is nxt or q.chain is c and q.ticket <= c.consumed and (not q.echo or c.sent.count(None) == len(c.sent)):
+                            q.done, q.error, q.transfers = True, error if q is nxt else None, n if q is nxt else 0
+                    self.queue = [q for q in self.queue if not q.done]
+                    self.cv.notify_all()
+        finally:
+            with self.cv:
+                self.running = False
+                self.cv.notify_all()
+        if req.error:
+            raise req.error
+        return req.transfers
+
+class Reply:
+    """ placeholder for the reply to a register access queued on a Chain
+        value and status are filled in when the chain is flushed
+    """
+    __slots__ = ('regnum', 'val', 'signed', 'after', 'callback', 'value', 'status', 'done', 'tries')
+
+    def __init__(self, regnum, val=None, signed=False, after=None, callback=None):
+        self.regnum = regnum
+        self.val = val  # None for a read, an int or a callable evaluated when the datagram is sent
+        self.signed = signed
+        self.after = after  # Reply that must be complete before this datagram is sent
+        self.callback = callback  # called with the value when the reply has arrived
+        self.value = None
+        self.status = None
+        self.done = False
+        self.tries = 0  # transmissions of a write so far
+
+
+class Chain:
+    """
+    defines an SPI bus and chip select shared by one or more daisy-chained TMC5130 drivers
+    the Motor objects on a chain submit register accesses to it, and flush() merges the pending
+    accesses of all drives into one frame per transfer
+    transmission errors are handled per drive: a write whose echo does not match is sent again (up to
+    RETRIES times), and a drive that reports a reset gets its shadowed configuration written again,
+    while the other drives on the chain carry on
+    """
+
+    def __init__(self, spi, chip_select, num_of_motors=1, phase=1, polarity=1, baudrate=None, name=None):
+        """
+        :param spi: busio.SPI object
+        :param chip_select: digitalio.DigitalInOut object
+        :param num_of_motors: int, number of drives on the chain
+        :param baudrate: int, None loads the baudrate characterized for name (see characterize())
+        :param name: str, identifies the chain in BAUDRATE_FILE, e.g. 'dock'
+        """
+        assert 1 <= num_of_motors <= 4
+        self.spi = spi
+        self.cs = chip_select
+        if self.cs:
+            self.cs.switch_to_output(True)  # initialize chipselect pin
+        self.num_of_motors = num_of_motors
+        self.phase = phase
+        self.polarity = polarity
+        self.name = name
+        if baudrate is None:
+            baudrate = load_baudrate(name, phase, polarity)
+        self.baudrate = baudrate
+        self.bus = Bus.get(spi)
+        self.lock = threading.Lock()  # protects the queue
+        self.Status = [None] * num_of_motors
+        self.queue = [[] for _ in range(num_of_motors)]
+        self.submitted = 0  # number of accesses queued so far
+        self.consumed = 0  # number of accesses sent so far
+        self.outbuf = bytearray(b'\x00' * PKTLEN * num_of_motors)
+        self.inbuf = bytearray(b'\x00' * PKTLEN * num_of_motors)
+        self.transfers = 0
+        self._batch = 0
+        self.max_age = SNAPSHOT_MAX_AGE
+        self.snap = None
+        self.snap_time = None
+        self.events = [0] * num_of_motors  # RAMP_STAT event bits collected by snapshot()
+        self.shadow = [{} for _ in range(num_of_motors)]  # last value written to the SHADOW_REGS of each drive
+        self.sent = [None] * num_of_motors  # datagrams whose reply arrives with the next transfer
+        self.inject = [[] for _ in range(num_of_motors)]  # retransmissions and replays, sent before the queue
+        self.txerrors = [0] * num_of_motors  # writes whose echo did not match
+        self.resets = [0] * num_of_motors  # resets detected and recovered from
+        self.failed = [False] * num_of_motors  # True if a write could not be delivered after RETRIES attempts
+        self.recover = True  # retransmit mismatched writes and replay the configuration after a reset
+        self.poller = Poller(self)
+
+    @classmethod
+    def get(cls, spi, chip_select, num_of_motors=1, phase=1, polarity=1, baudrate=None, name=None):
+        """ returns the chain on spi/chip_select, creating it on first use
+            so all Motor objects on the same chip select share the same chain
+        """
+        for c in _chains:
+            if c.spi is spi and c.cs is chip_select:
+                if c.num_of_motors != num_of_motors:
+                    raise ValueError(f"chain has {c.num_of_motors} drives, not {num_of_motors}")
+                return c
+        c = cls(spi, chip_select, num_of_motors, phase, polarity, baudrate, name)
+        _chains.append(c)
+        return c
+
+    def __enter__(self):
+        self.bus.acquire(self.phase, self.polarity, self.baudrate)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.cs: self.cs.value = True
+        self.bus.release()
+
+    def write_read(self, outbuf, inbuf):
+        if self.cs: self.cs.value = False
+        if DEBUG: print("DEBUG: cmd=self.spi.write_readinto(outbuf, inbuf)", " outbuf=", outbuf, " inbuf=", inbuf)
+        self.spi.write_readinto(outbuf, inbuf)  # read
+        if self.cs: self.cs.value = True
+        self.transfers += 1
+
+    @property
+    def batching(self):
+        return self._batch > 0
+
+    def batch(self):
+        """ returns a context manager that defers flushing until it is left, e.g.
+                with chain.batch():
+                    for m in motors:
+                        m.moveto(pos)
+            sends the moves of all drives in the same frames
+        """
+        return _Batch(self)
+
+    def submit(self, drive, regnum, val=None, signed=False, after=None, callback=None, force=False):
+        """ queues a register access for a drive and returns its Reply
+            val=None reads the register, otherwise val (or val() if it is callable) is written
+            the datagram is held back until the Reply given as after is complete
+            accesses to SHADOW_REGS are answered from self.shadow when the value is known, unless forced:
+            reads return the shadowed value and writes of an unchanged value are skipped
+        """
+        r = Reply(regnum, val, signed, after, callback)
+        if regnum in SHADOW_REGS and not callable(val) and not force:
+            shadow = self.shadow[drive]
+            if regnum in shadow and (val is None or val == shadow[regnum]):
+                r.value, r.status, r.done = shadow[regnum], self.Status[drive], True
+                if callback: callback(r.value)
+                return r
+            if val is not None:
+                shadow[regnum] = val
+        with self.lock:
+            self.queue[drive].append(r)
+            self.submitted += 1
+        if val is not None:
+            self.snap_time = None  # a write may change the state of the drive
+        return r
+
+    def configure(self, profiles, verify=True):
+        """ writes a register image to every drive of the chain in one pipelined burst
+            profiles: a profile (see compile_profile()) for all drives or a list with one per drive,
+                      None leaves a drive alone
+            the reset flags are cleared, the echo of all writes is checked and READABLE_REGS are read
+            back in a single verify pass (verify=True)
+            raises ConnectionError if a driver does not accept its configuration
+        """
+        if type(profiles) not in (list, tuple):
+            profiles = [profiles] * self.num_of_motors
+        images = [None if p is None else compile_profile(p) for p in profiles]
+        writes = {}
+        for d, image in enumerate(images):
+            if image is None:
+                continue
+            self.invalidate(d)
+            self.submit(d, GSTAT)  # read GSTAT to clear the reset flag
+            writes[d] = [(self.submit(d, r, v), v) for r, v in image]
+        self.flush()
+        if not verify:
+            return
+        reads = {d: [(self.submit(d, r, force=True), v) for r, v in images[d] if r in READABLE_REGS] for d in writes}
+        self.flush()
+        for d in writes:
+            for r, v in writes[d] + reads[d]:
+                if r.value != v % 2**32:
+                    self.invalidate(d)
+                    raise ConnectionError(f'TMC5130 #{d} not connected (register 0x{r.regnum:02X} is 0x{r.value:08X}, not 0x{v:08X})')
+
+    def invalidate(self, drive=None):
+        """ forgets the shadowed registers of a drive (all drives if None), e.g. after a reset
+            so the next accesses go to the driver
+        """
+        for d in range(self.num_of_motors) if drive is None else (drive,):
+            self.shadow[d].clear()
+
+    def snapshot(self, max_age=None):
+        """ returns [(status, XACTUAL, RAMP_STAT), ...] for all drives on the chain
+            all drives are read in one pipelined burst of 3 transfers and the result is reused
+            until it is older than max_age [s] (default self.max_age) or a register is written
+            the RAMP_STAT bits that are cleared upon read are collected in self.events
+        """
+        if max_age is None:
+            max_age = self.max_age
+        now = time.monotonic()
+        if self.snap_time is None or now - self.snap_time > max_age:
+            replies = [(self.submit(d, XACTUAL), self.submit(d, RAMP_STAT)) for d in range(self.num_of_motors)]
+            self.flush(priority=PRIORITY_POLL)
+            self.snap = [(self.Status[d], x.value, r.value) for d, (x, r) in enumerate(replies)]
+            for d, (x, r) in enumerate(replies):
+                self.events[d] |= r.value & RAMP_STAT_EVENTS
+            self.snap_time = now
+        return self.snap
+
+    def _goto(self, drive, target, speed, after=None):
+        self.submit(drive, RAMPMODE, 0)
+        self.submit(drive, VMAX, speed)
+        self.submit(drive, XTARGET, target if callable(target) else target % 2**32, after=after)
+
+    def home_all(self, drives=None, search=-133_120, backoff=22_187, fast=26_624, slow=5_325, timeout=10,
+                 interval=0.005):
+        """ homes the drives (all if None) on their reference switch at the same time
+            each drive searches the switch at the fast speed, backs off, approaches it again at the slow
+            speed and moves to the latched switch position, which becomes XACTUAL=0
+            the commands of all drives share frames, so homing takes as long as the slowest drive
+            SW_MODE must enable the stop switch with position latching (see the dock-tilt profile)
+            returns a list with True for homed drives, False for failed ones and None for the others
+            :param search: int, search distance [microsteps], the sign selects the left (-) or right (+) switch
+            :param backoff: int, distance [microsteps] to move off the switch before the slow approach
+            :param fast: int, VMAX for searching and backing off
+            :param slow: int, VMAX for the approach and the move to the latched position
+            :param timeout: float, time [s] after which a drive that is not homed is stopped and fails
+            the VMAX each drive had before is written back when it is done, a stopped drive is left in
+            positioning mode at its standstill position
+        """
+        switch = 0b0100_0000 if search < 0 else 0b1000_0000  # status_stop_l / status_stop_r
+        backoff = abs(backoff) if search < 0 else -abs(backoff)
+        drives = range(self.num_of_motors) if drives is None else drives
+        state = [None] * self.num_of_motors
+        for d in drives:
+            state[d] = 'start'
+        result = [None] * self.num_of_motors
+        vmax = [self.shadow[d].get(VMAX) for d in range(self.num_of_motors)]
+
+        def finish(d, homed):
+            if vmax[d] is not None:
+                self.submit(d, VMAX, vmax[d])
+            state[d], result[d] = 'done', homed
+
+        t_end = time.monotonic() + timeout
+        while any(st not in (None, 'done') for st in state):
+            snap = self.snapshot(max_age=0)
+            with self.batch():
+                for d, st in enumerate(state):
+                    if st in (None, 'done'):
+                        continue
+                    status, x, _ = snap[d]
+                    arrived, stopped, pressed = status & 0x20, status & 0x08, status & switch
+                    if st == 'abort':  # back to positioning mode once stopped, without moving
+                        if stopped or time.monotonic() > t_end + timeout:
+                            self.submit(d, XTARGET, x)
+                            self.submit(d, RAMPMODE, 0)
+                            finish(d, False)
+                    elif time.monotonic() > t_end:
+                        self.submit(d, RAMPMODE, 1)  # velocity mode, ramp down to VMAX=0
+                        self.submit(d, VMAX, 0)
+                        state[d] = 'abort'
+                    elif st == 'start':  # move off the switch if it is already pressed
+                        if pressed:
+                            self._goto(d, x + backoff, fast)
+                            state[d] = 'clear'
+                        else:
+                            self._goto(d, x + search, fast)
+                            state[d] = 'search'
+                    elif st == 'clear' and arrived:
+                        if pressed:
+                            finish(d, False)
+                        else:
+                            self._goto(d, x + search, fast)
+                            state[d] = 'search'
+                    elif st == 'search':  # fast seek
+                        if pressed:
+                            state[d] = 'stopping'
+                        elif arrived:
+                            finish(d, False)  # switch not found
+                    elif st == 'stopping' and stopped:
+                        self._goto(d, x + backoff, fast)
+                        state[d] = 'backoff'
+                    elif st == 'backoff' and arrived:
+                        if pressed:
+                            finish(d, False)
+                        else:
+                            self._goto(d, x - 2 * backoff, slow)
+                            state[d] = 'approach'
+                    elif st == 'approach':  # slow approach, latches XACTUAL into XLATCH
+                        if pressed and stopped:
+                            latch = self.submit(d, XLATCH)
+                            self._goto(d, lambda latch=latch: latch.value, slow, after=latch)
+                            state[d] = 'return'
+                        elif arrived:
+                            finish(d, False)
+                    elif st == 'return' and arrived:  # at the latched position, set home
+                        self.submit(d, RAMPMODE, 3)  # hold mode, XACTUAL and XTARGET can be changed without moving
+                        self.submit(d, XACTUAL, 0)
+                        self.submit(d, XTARGET, 0)
+                        self.submit(d, RAMPMODE, 0)
+                        finish(d, True)
+            time.sleep(interval)
+        return result
+
+    def characterize(self, baudrates=BAUDRATES, frames=200, save=True, path=BAUDRATE_FILE):
+        """ measures which baudrates the chain sustains and switches to the fastest reliable one
+            the baudrates are tried in ascending order, each with frames frames of non-destructive traffic
+            per drive: a read of IOIN, whose VERSION byte is known, and a rewrite of GCONF with its current
+            value, whose echo is checked
+            the sweep stops at the first baudrate with errors, and the rate below it is chosen, one step
+            lower still for margin unless it is the slowest
+            the configuration of all drives is rewritten at the chosen baudrate afterwards
+            the result is stored for self.name and the SPI mode (save=True, see load_baudrate())
+            corrupted datagrams can write any register, so run it with the motors unloaded at standstill
+            returns the chosen baudrate and {baudrate: error rate}
+        """
+        n = self.num_of_motors
+        baudrates = sorted(baudrates)
+        rates = {}
+        with self:  # hold the bus for the whole sweep
+            base = self.baudrate
+            self.baudrate = baudrates[0]
+            ref = [(self.submit(d, IOIN), self.submit(d, GCONF, force=True)) for d in range(n)]
+            self.flush()
+            version = [v.value >> 24 for v, g in ref]
+            gconf = [g.value for v, g in ref]
+            self.recover = False  # count errors, do not correct them
+            try:
+                for b in baudrates:
+                    self.baudrate = b
+                    errors = self.txerrors[:]
+                    replies = [self.submit(d, IOIN) for _ in range(frames) for d in range(n)]
+                    for _ in range(frames):
+                        for d in range(n):
+                            self.submit(d, GCONF, gconf[d], force=True)
+                    self.flush()
+                    errors = sum(self.txerrors) - sum(errors) + sum(r.value >> 24 != version[i % n] for i, r in enumerate(replies))
+                    rates[b] = errors / (2 * frames * n)
+                    if errors:
+                        break
+            finally:
+                self.recover = True
+                ok = [b for b in baudrates if b in rates and not rates[b]]
+                if len(ok) < len(rates) and len(ok) > 1:
+                    ok.pop()  # margin below the first failing baudrate
+                chosen = ok[-1] if ok else base
+                self.baudrate = chosen
+                for d in range(n):  # repair what the failing rates may have written
+                    self.submit(d, GCONF, gconf[d], force=True)
+                    for r, v in self.shadow[d].items():
+                        if r != GCONF:
+                            self.submit(d, r, v, force=True)
+                    self.failed[d] = False
+                self.flush()
+        if save and self.name is not None:
+            save_baudrate(self.name, self.phase, self.polarity, chosen, path)
+        return chosen, rates
+
+    def _recover(self, drive, in_flight, pos):
+        """ queues the recovery of a drive that reports a reset (status bit 0) in front of its queue:
+            a read of GSTAT, which clears the reset flag, and the shadowed configuration
+            nothing is queued if a GSTAT read is already on its way, e.g. from configure()
+        """
+        pending = self.inject[drive] + self.queue[drive][pos:] + [r for r in in_flight if r is not None]
+        if self.failed[drive] or any(r.regnum == GSTAT and r.val is None for r in pending):
+            return
+        self.resets[drive] += 1
+        shadow = self.shadow[drive]
+        regs = [r for r in shadow if r != RAMPMODE] + [r for r in shadow if r == RAMPMODE]  # mode last
+        self.inject[drive][:0] = [Reply(GSTAT)] + [Reply(r, shadow[r]) for r in regs]
+
+    def flush(self, echo=True, priority=PRIORITY_CONTROL):
+        """ sends all pending register accesses and completes their replies
+            the n-th pending access of every drive goes into the same frame, drives with nothing
+            (left) to send get a dummy read of GCONF
+            with echo=False, writes in the last frame are not followed by a dummy frame, their echo
+            is collected by the first transfer of the next flush
+            the flush is scheduled on the bus with the given priority (see Bus)
+            returns the number of transfers
+        """
+        return self.bus.transact(self, priority, echo)
+
+    def _flush(self, echo=True):
+        n = self.num_of_motors
+        pos = [0] * n
+        sent = self.sent  # datagrams of the previous frame, their replies arrive with the next one
+        transfers = 0
+        recovered = 0  # bit mask of the drives recovered from a reset in this flush
+        try:
+            while True:
+                frame = [None] * n
+                for d in range(n):
+                    q = self.queue[d]
+                    if self.inject[d]:
+                        r = self.inject[d].pop(0)
+                    else:
+                        r = q[pos[d]] if pos[d] < len(q) else None
+                        if r is not None and r.after is not None and not r.after.done:
+                            r = None  # hold back until the reply it depends on has arrived
+                        if r is not None:
+                            pos[d] += 1
+                    if r is None:
+                        DATAGRAM.pack_into(self.outbuf, d * PKTLEN, GCONF, 0)  # dummy read
+                    else:
+                        if callable(r.val):
+                            r.val = r.val()
+                        if r.val is None:
+                            DATAGRAM.pack_into(self.outbuf, d * PKTLEN, r.regnum, 0)
+                        else:
+                            (DATAGRAM_SIGNED if r.signed else DATAGRAM).pack_into(self.outbuf, d * PKTLEN, r.regnum | 0x80, r.val)
+                            r.tries += 1
+                            if r.regnum in SHADOW_REGS:
+                                self.shadow[d][r.regnum] = r.val
+                    frame[d] = r
+                if frame.count(None) == n:
+                    if any(pos[d] < len(self.queue[d]) for d in range(n)) and sent.count(None) == n:
+                        raise ValueError('register access waits for a reply that is not queued')
+                    if sent.count(None) == n or not echo and all(r is None or r.val is not None for r in sent):
+                        break
+                self.write_read(self.outbuf, self.inbuf)
+                transfers += 1
+                if DEBUG: print(f"{' x'.join(f'{o:02X}' for o in self.outbuf):56}  {' x'.join(f'{i:02X}' for i in self.inbuf):56}")
+                for d in range(n):
+                    r = sent[d]
+                    self.Status[d], v = (DATAGRAM_SIGNED if r is not None and r.signed else DATAGRAM).unpack_from(self.inbuf, d * PKTLEN)
+                    if self.recover and self.Status[d] & 0x01 and not recovered >> d & 1:
+                        recovered |= 1 << d
+                        self._recover(d, [r, frame[d]], pos[d])
+                    if r is None:
+                        continue
+                    if r.val is not None and (v - r.val) % 2**32:
+                        self.txerrors[d] += 1
+                        if not self.recover:
+                            self.shadow[d].pop(r.regnum, None)
+                        elif r.tries <= RETRIES:
+                            self.inject[d].append(r)  # send only this datagram again
+                            continue
+                        else:
+                            self.failed[d] = True
+                            self.shadow[d].pop(r.regnum, None)  # the driver has some other value
+                            for x in self.inject[d]:  # give up on the pending retransmissions and replays as well
+                                x.done = True
+                                if x.val is not None: self.shadow[d].pop(x.regnum, None)
+                            self.inject[d].clear()
+                    elif r.val is not None:
+                        self.failed[d] = False
+                    r.status, r.value, r.done = self.Status[d], v, True
+                    if r.callback: r.callback(v)
+                sent = frame
+        finally:
+            self.sent = sent
+            with self.lock:
+                for d in range(n):
+                    del self.queue[d][:pos[d]]
+                self.consumed += sum(pos)
+        return transfers
+
+
+class _Batch:
+
+    def __init__(self, chain):
+        self.chain = chain
+
+    def __enter__(self):
+        self.chain._batch += 1
+        return self.chain
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.chain._batch -= 1
+        if not self.chain._batch:
+            self.chain.flush()
+
+
+class Poller:
+    """
+    services the awaitable conditions of all drives on a chain from one asyncio task
+    each poll is one chain.snapshot(), the interval adapts to the predicted arrival of the moves
+    waited for and stays at interval while waiting for switches or stalls
+    """
+
+    def __init__(self, chain, interval=0.005, max_interval=0.1, margin=0.02):
+        """
+        :param chain: Chain object
+        :param interval: float, poll interval [s] close to an event
+        :param max_interval: float, longest poll interval [s] while far from the predicted arrival
+        :param margin: float, time [s] before the predicted arrival when fast polling starts
+        """
+        self.chain = chain
+        self.interval = interval
+        self.max_interval = max_interval
+        self.margin = margin
+        self.waiters = []  # [drive, condition, future, eta]
+        self.task = None
+        self.wakeup = None
+
+    def wait(self, drive, condition, eta=None):
+        """ returns a future that is completed with the snapshot (status, XACTUAL, RAMP_STAT) of drive
+            as soon as condition(status, xactual, ramp_stat) is true
+            eta is the predicted time.monotonic() of the event, or None if unknown
+        """
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self.waiters.append((drive, condition, fut, eta))
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = loop.create_task(self._run())
+        else:
+            self.wakeup.set()
+        return fut
+
+    async def _run(self):
+        while self.waiters:
+            self.wakeup.clear()
+            try:
+                snap = self.chain.snapshot(max_age=0)
+            except Exception as e:
+                for drive, condition, fut, eta in self.waiters:
+                    if not fut.done():
+                        fut.set_exception(e)
+                self.waiters = []
+                break
+            now = time.monotonic()
+            dt = self.max_interval
+            waiting = []
+            for w in self.waiters:
+                drive, condition, fut, eta = w
+                if fut.done():  # cancelled, e.g. timed out
+                    continue
+                if condition(*snap[drive]):
+                    fut.set_result(snap[drive])
+                    continue
+                waiting.append(w)
+                dt = min(dt, self.interval if eta is None else max(eta - self.margin - now, self.interval))
+            self.waiters = waiting
+            if waiting:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), dt)
+                except asyncio.TimeoutError:
+                    pass
+
+
+class Agitator:
+    """
+    rocks motors back and forth between two positions from one background thread
+    the ramp generator runs every stroke on its own, the thread sleeps until the predicted end of the next
+    stroke of any motor, checks the arrival with one chain snapshot and writes the next XTARGET,
+    so a rocking motor costs one snapshot and one datagram per stroke
+    when rocking ends the motor moves back to the centre, then the VMAX it had before rocking is written back
+    """
+
+    def __init__(self, margin=0.005, interval=0.002):
+        """
+        :param margin: float, time [s] before the predicted end of a stroke when the arrival is checked
+        :param interval: float, time [s] between checks of a stroke that has not arrived yet
+        """
+        self.margin = margin
+        self.interval = interval
+        # {motor: [(target, target), next, strokes left (-1: returning to the centre), time of the next check,
+        #          stroke duration, VMAX before, centre, duration of the return to the centre]}
+        self.strokes = {}
+        self.cv = threading.Condition()  # protects self.strokes, never held during bus traffic
+        self.io = threading.Lock()  # held while the thread or start() writes to the rocking motors
+        self.thread = None
+
+    def start(self, motor, amplitude, period, center=None, strokes=None):
+        """ rocks motor between center + amplitude and center - amplitude [microsteps], one cycle per period [s]
+            center defaults to the centre of the running rocking, else to the target of the last move of the motor
+            strokes: number of strokes (half cycles), None rocks until stop()
+            VMAX is chosen so a stroke takes period/2 with the other ramp registers of the motor
+            raises ValueError if that needs more than the VMAX of the motor before rocking, see Motor.speed_for()
+        """
+        with self.io:
+            with self.cv:
+                s = self.strokes.get(motor)
+            if s is not None:  # already rocking, keep the VMAX from before and the centre
+                vmax = s[5]
+                if center is None:
+                    center = s[6]
+            else:
+                vmax = motor._vmax if motor._vmax is not None else motor.chain.shadow[motor.motor_num].get(VMAX)
+                if center is None:
+                    center = motor.TargetPos if motor.TargetPos is not None else motor.reg(XACTUAL)
+            amplitude = abs(int(amplitude))
+            speed = motor.speed_for(2 * amplitude, period / 2, vmax)
+            targets = ((center + amplitude) % 2**32, (center - amplitude) % 2**32)
+            motor.move(abspos=targets[0], speed=speed)  # the first stroke starts where the motor is
+            with self.cv:
+                self.strokes[motor] = [targets, 1, None if strokes is None else strokes - 1,
+                                       motor.eta() or time.monotonic(), motor.duration(2 * amplitude), vmax,
+                                       center, motor.duration(amplitude)]
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, daemon=True)
+                    self.thread.start()
+                self.cv.notify()
+
+    def stop(self, motor):
+        """ stops rocking motor after the current stroke and moves it back to the centre,
+            then its previous VMAX is restored
+        """
+        with self.cv:
+            s = self.strokes.get(motor)
+            if s is not None and s[2] != -1:
+                s[2] = 0
+                self.cv.notify()
+
+    def running(self, motor):
+        """ returns True while motor is rocking, including the last stroke and the return to the centre
+        """
+        return motor in self.strokes
+
+    def _run(self):
+        while True:
+            with self.cv:
+                if not self.strokes:
+                    self.thread = None
+                    return
+                now = time.monotonic()
+                dt = min(s[3] for s in self.strokes.values()) - self.margin - now
+                if dt > 0:
+                    self.cv.wait(dt)
+                    continue
+                chains = {}
+                for m, s in self.strokes.items():
+                    if s[3] - self.margin <= now:
+                        chains.setdefault(m.chain, []).append((m, s))
+            with self.io:
+                for chain, due in chains.items():
+                    snap = chain.snapshot(max_age=0)
+                    now = time.monotonic()
+                    with self.cv:  # submit() only queues, the bus is used by flush() outside the lock
+                        for m, s in due:
+                            if self.strokes.get(m) is not s:  # restarted meanwhile
+                                continue
+                            if not snap[m.motor_num][0] & 0x20:  # position_reached
+                                s[3] = now + self.margin + self.interval
+                                continue
+                            if s[2] == -1:  # back at the centre
+                                del self.strokes[m]
+                                if s[5] is not None:
+                                    chain.submit(m.motor_num, VMAX, s[5])
+                                continue
+                            if s[2] == 0:  # last stroke done, return to the centre
+                                center = s[6] % 2**32
+                                chain.submit(m.motor_num, XTARGET, center)
+                                m.Pos, m.TargetPos, m.t_move = m.TargetPos, center, now
+                                s[2] = -1
+                                s[3] = now + s[7]
+                                continue
+                            target = s[0][s[1]]
+                            chain.submit(m.motor_num, XTARGET, target)
+                            m.Pos, m.TargetPos, m.t_move = m.TargetPos, target, now
+                            s[1] ^= 1
+                            s[2] = None if s[2] is None else s[2] - 1
+                            s[3] = now + s[4]
+                    chain.flush(echo=False)
+
+
+class Strobe:
+    """
+    position compare event of a drive, armed with Motor.strobe()
+    the driver pulses SWP_DIAG1 when XACTUAL passes X_COMPARE, with pin given the pulse is caught as a
+    GPIO edge (RPi.GPIO), otherwise a thread watches XACTUAL for the crossing in chain snapshots
+    the event is delivered once: to the callback, to wait() and to coroutines awaiting the Strobe
+    """
+
+    def __init__(self, motor, position, callback=None, pin=None, interval=0.002):
+        """
+        :param motor: Motor object
+        :param position: int, XACTUAL [microsteps] to fire at
+        :param callback: called with the Strobe when it fires, from the GPIO or polling thread
+        :param pin: int or board pin, GPIO (BCM number) connected to SWP_DIAG1, None to poll
+        :param interval: float, poll interval [s] without pin
+        """
+        self.motor = motor
+        self.position = position % 2**32
+        self.callback = callback
+        self.pin = getattr(pin, 'id', pin)
+        self.interval = interval
+        self.time = None  # time.monotonic() when the strobe fired
+        self.event = threading.Event()
+        self._lock = threading.Lock()
+        self._futures = []
+        self._armed = True
+        self._gconf = None  # GCONF before the strobe, written back by cancel()
+        motor.reg(X_COMPARE, self.position)
+        if self.pin is not None and GPIO is not None:
+            self._gconf = motor.reg(GCONF)
+            motor.reg(GCONF, self._gconf | GCONF_DIAG1_POSCOMP_PUSHPULL)
+            if GPIO.getmode() is None:
+                GPIO.setmode(GPIO.BCM)
+            GPIO.setup(self.pin, GPIO.IN)
+            GPIO.add_event_detect(self.pin, GPIO.RISING, callback=self._edge)
+        else:
+            self.pin = None
+            threading.Thread(target=self._poll, daemon=True).start()
+
+    def _edge(self, channel):
+        self._fire()
+
+    def _poll(self):
+        chain, drive = self.motor.chain, self.motor.motor_num
+        last = None
+        while self._armed:
+            d = (chain.snapshot(max_age=self.interval)[drive][1] - self.position + 2**31) % 2**32 - 2**31
+            if d == 0 or last is not None and (d < 0) != (last < 0):
+                self._fire()
+                return
+            last = d
+            time.sleep(self.interval)
+
+    def _fire(self):
+        with self._lock:
+            if not self._armed:
+                return
+            self.time = time.monotonic()
+            self.event.set()
+            futures, self._futures = self._futures, []
+        self.cancel()
+        for loop, fut in futures:
+            loop.call_soon_threadsafe(lambda f=fut: f.done() or f.set_result(self))
+        if self.callback:
+            self.callback(self)
+
+    def fired(self):
+        """ returns True once the drive has passed the position
+        """
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        """ blocks until the strobe has fired, returns False if timeout [s] has expired first
+        """
+        return self.event.wait(timeout)
+
+    def cancel(self):
+        """ disarms the strobe, it does not fire afterwards, and restores the SWP_DIAG1 mode of GCONF
+        """
+        with self._lock:
+            self._armed = False
+            pin, self.pin = self.pin, None
+            gconf, self._gconf = self._gconf, None
+        if pin is not None:
+            GPIO.remove_event_detect(pin)
+        if gconf is not None:
+            self.motor.reg(GCONF, gconf)
+
+    def __await__(self):
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        with self._lock:
+            if self.time is not None:
+                fut.set_result(self)
+            else:
+                self._futures.append((loop, fut))
+        return fut.__await__()
+
+
 class Motor:
     """
     defines the TMC5130 stepper driver as an object
     """
 
 
-    def __init__(self, spi, chip_select, gconf, ihold_irun, num_of_motors=1, motor_num=0, phase=1, polarity=1, baudrate=100_000):
+    def __init__(self, spi, chip_select, gconf=None, ihold_irun=None, num_of_motors=1, motor_num=0, phase=1, polarity=1,
+                 baudrate=None, fclk=13e6, profile='default', init=True, name=None, steps=200, usteps=256):
         """
         :param spi: busio.SPI object
         :param chip_select: digitalio.DigitalInOut object
-        :param baudrate:
+        :param gconf: int, overrides GCONF of the profile
+        :param ihold_irun: int, overrides IHOLD_IRUN of the profile
+        :param baudrate: int, None loads the baudrate characterized for the chain (see Chain.characterize())
+        :param fclk: the clock frequency, ~13Mhz when using the internal clock
+        :param profile: str or dict, register image (see PROFILES)
+        :param init: bool, write the profile to the driver, False if the chain is configured as a whole (see motors())
+        :param name: str, name of the chain, e.g. 'dock'
+        :param steps: int, full steps/round of the motor
+        :param usteps: int, microsteps/full step
         initializes the TMC5130 according to the datasheet example for positioning
         """
         assert 1 <= num_of_motors <= 4
         assert 0 <= motor_num <= num_of_motors-1
         self.spi = spi
         self.cs = chip_select
-        if self.cs:
-            self.cs.switch_to_output(True)  # initialize chipselect pin
         self.num_of_motors = num_of_motors
         self.motor_num = motor_num
         self.phase = phase
         self.polarity = polarity
-        self.baudrate = baudrate
-        self.Status = None
+        self._fclk = fclk
+        self._steps = steps
+        self._usteps = usteps
+        self._spr = steps * usteps  # steps/round (51_200 for 200 steps/round and 256 usteps/step)
+        self.chain = Chain.get(spi, chip_select, num_of_motors, phase, polarity, baudrate, name)
         self.Pos = None
         self.TargetPos = None
-        self.outbuf = bytearray(b'\x00' * 5 * num_of_motors)
-        self.inbuf = bytearray(b'\x00' * 5 * num_of_motors)
+        self.t_move = None  # time.monotonic() when the last positioning move was sent
+        self.priority = PRIORITY_CONTROL  # bus priority of register accesses, see Bus
+        self._vmax = None  # VMAX before stop()
         self.error = True
 
+        if init:
+            regs = {}
+            if gconf is not None:
+                regs['GCONF'] = gconf
+            if ihold_irun is not None:
+                regs['IHOLD_IRUN'] = ihold_irun
+            self.configure(compile_profile(profile, **regs))
+        self.error = False
 
+    def configure(self, profile, verify=True):
+        """ writes a register image (see compile_profile()) to the driver in one pipelined burst
+            raises ConnectionError if the driver does not accept it
+        """
+        profiles = [None] * self.num_of_motors
+        profiles[self.motor_num] = profile
         with self:
-            self.reg(GSTAT)  # read GSTAT 0x01 to clear reset flag
-            if self.reg(GCONF, gconf) == gconf:
-                self.error = False
-            else:
-                raise ConnectionError('TMC5130 not connected')
-                #self.error = 'TMC5130 not connected'
-
-            self.reg(CHOPCONF, 0x000100C5)  # TOFF=3, HSTRT=4, HEND=1, TBL=2, CHM=0 (spreadCycle)
-            self.reg(IHOLD_IRUN, ihold_irun)  # IHOLDDELAY=1, IRUN=4/32 of max, IHOLD=2/32 of max
-            self.reg(TPWMTHRS, 0) # upper velocity for StealthChop)
-            self.reg(A1, 1000)
-            self.reg(V1, 5000)
-            self.reg(AMAX, 5000)
-            self.reg(VMAX, 20000)
-            self.reg(DMAX, 5000)
-            self.reg(D1, 5000)
-            self.reg(VSTOP, 10)
-            self.reg(RAMPMODE, 0)  # RAMPMODE 0x20 = 0 (Target position move)
+            self.chain.configure(profiles, verify)
 
     def __enter__(self):
-        while self.spi.try_lock():
-            pass
-        while self.spi.try_lock():
-            pass
-        self.spi.configure(phase=self.phase, polarity=self.polarity, baudrate=self.baudrate)
-
+        self.chain.__enter__()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.cs: self.cs.value = True
-        self.spi.unlock()
+        self.chain.__exit__(exc_type, exc_val, exc_tb)
+
+    @property
+    def Status(self):
+        """ the status byte of the drive returned with the last datagram """
+        return self.chain.Status[self.motor_num]
+
+    @property
+    def baudrate(self):
+        """ the SPI baudrate of the chain, changed by Chain.characterize() """
+        return self.chain.baudrate
 
     def write_read(self,outbuf, inbuf):
-        if self.cs: self.cs.value = False
-        if DEBUG: print("DEBUG: cmd=self.spi.write_readinto(outbuf, inbuf)", " outbuf=", outbuf, " inbuf=", inbuf)
-        self.spi.write_readinto(outbuf, inbuf)  # read
-        if self.cs: self.cs.value = True
+        self.chain.write_read(outbuf, inbuf)
 
     def reg(self,
             regnum,
@@ -131,24 +1149,31 @@ class Motor:
             if a value is given, it is written to the register
             self.Status is updates with the current status byte
         """
+        return self.pipeline([(regnum, val)], signed=signed)[0]
 
-        if signed:
-            f = '>Bl'  # format string for signed long
-        else:
-            f = '>BL'  # format string for unsigned long
-        if val is None:
-            #print("read", hex(regnum))
-            struct.pack_into(f, self.outbuf, self.motor_num * 5, regnum, 0)
-        else:
-            #print("write", hex(regnum | 0x80), hex(val))
-            struct.pack_into(f, self.outbuf, self.motor_num * 5, regnum | 0x80, val)
-        self.write_read(self.outbuf, self.inbuf)  # read
-        struct.pack_into(f, self.outbuf, self.motor_num * 5, regnum, 0)
-        self.write_read(self.outbuf, self.inbuf)  # read
-        self.Status, v = struct.unpack_from(f, self.inbuf, self.motor_num * 5)
-        if val is None: val=0  # *******************9
-        if DEBUG:print(f'{regnum:02X},    {val:8X}, {self.Status:08b}, {v:8X} {repr(v==val):7} {repr(self.outbuf):28} {repr(bytes(self.inbuf)):28}')  # *******************
-        return v
+    def pipeline(self,
+                 regs,
+                 signed=False
+                 ):
+        """ sends a list of register accesses back-to-back and returns the list of replies
+            each entry is either a register number (read) or a tuple (regnum, val[, signed])
+            with val=None for a read, the reply of a write is the echoed value
+            the TMC5130 returns read data one datagram late, so each datagram collects the reply
+            to the previous one and N accesses take N+1 transfers instead of 2N
+            self.Status is updated with the current status byte
+        """
+        # inside chain.batch() the accesses are only queued and the Reply objects are returned
+        replies = []
+        for r in regs:
+            if type(r) is int:
+                r = (r,)
+            replies.append(self.chain.submit(self.motor_num, r[0],
+                                             r[1] if len(r) > 1 else None,
+                                             r[2] if len(r) > 2 else signed))
+        if self.chain.batching:
+            return replies
+        self.chain.flush(priority=self.priority)
+        return [r.value for r in replies]
 
 
     def move(self,
@@ -158,34 +1183,173 @@ class Motor:
              ):
         """ moves the motor to a relative or absolute position at the speed given
             updates self.Status with the current status byte
-            returns the position before the move
+            returns the position before the move (its Reply inside chain.batch())
         """
         # moves the motor and returns the status and the current position
         # all arguments are optional
         # if only speed [rotations/s] is given, the sign determines the direction
         # if abspos or relpos are given, the sign of the optional speed is ignored
         # if relpos is given, abspos is ignored
-        self.Pos = self.reg(XACTUAL)
-        if relpos is not None:
-            self.reg(RAMPMODE, 0)
-            if speed is not None:
-                self.reg(VMAX, abs(speed))
-            self.TargetPos = (self.Pos + relpos) % 2**32
-            self.reg(XTARGET, self.TargetPos)
-        elif abspos is not None:
-            self.reg(RAMPMODE, 0)
+        chain = self.chain
+        pos = chain.submit(self.motor_num, XACTUAL, callback=self._set_pos)
+        if relpos is not None or abspos is not None:
+            chain.submit(self.motor_num, RAMPMODE, 0)
             if speed is not None:
-                self.reg(VMAX, abs(speed))
-            self.TargetPos = abspos % 2**32
-            self.reg(XTARGET, self.TargetPos)
-        elif speed is not None:
-            if speed < 0:
-                self.reg(RAMPMODE, 2)
+                chain.submit(self.motor_num, VMAX, abs(speed))
+            elif self._vmax is not None:
+                chain.submit(self.motor_num, VMAX, self._vmax)  # restore after stop()
+            self._vmax = None
+            if relpos is not None:
+                chain.submit(self.motor_num, XTARGET, lambda: self._set_target(pos.value + relpos), after=pos)
             else:
-                self.reg(RAMPMODE, 1)
-            self.reg(VMAX, abs(speed))
+                chain.submit(self.motor_num, XTARGET, self._set_target(abspos))
+            self.t_move = time.monotonic()
+        elif speed is not None:
+            chain.submit(self.motor_num, RAMPMODE, 2 if speed < 0 else 1)
+            chain.submit(self.motor_num, VMAX, abs(speed))
+            self.t_move = None
+        if chain.batching:
+            return pos
+        chain.flush(echo=False, priority=self.priority)
         return self.Pos
 
+    def home(self, **kwargs):
+        """ homes the motor on its reference switch, see Chain.home_all()
+            returns True if homed
+        """
+        homed = self.chain.home_all([self.motor_num], **kwargs)[self.motor_num]
+        self.Pos = self.TargetPos = 0 if homed else self.Pos
+        return homed
+
+    def stop(self):
+        """ safety stop: ramps the motor down to standstill, ahead of all queued bus requests
+            a following positioning move without speed restores the previous VMAX
+        """
+        if self._vmax is None:
+            self._vmax = self.chain.shadow[self.motor_num].get(VMAX)
+        self.chain.submit(self.motor_num, RAMPMODE, 1)  # velocity mode ramps down with AMAX
+        self.chain.submit(self.motor_num, VMAX, 0)
+        self.t_move = None
+        self.chain.flush(priority=PRIORITY_SAFETY)
+
+    def TPWMTHRS(self, rps=None):  # upper limit for stealth chop in rps
+        """ sets the velocity [rotations/s] above which the driver changes from StealthChop to spreadCycle
+            None: StealthChop at all velocities
+            StealthChop itself is switched on and off with stealthchop()
+            returns the register value
+        """
+        val = tstep(rps, self._steps, self._fclk)
+        self.reg(TPWMTHRS, val)
+        return val
+
+    def TCOOLTHRS(self, rps=None):
+        """ sets the velocity [rotations/s] above which CoolStep and the StallGuard2 output are active
+            returns the register value
+        """
+        val = tstep(rps, self._steps, self._fclk)
+        self.reg(TCOOLTHRS, val)
+        return val
+
+    def THIGH(self, rps=None):
+        """ sets the velocity [rotations/s] above which the driver uses the high velocity chopper mode
+            (and fullstep if enabled in CHOPCONF), None disables it
+            returns the register value
+        """
+        val = tstep(rps, self._steps, self._fclk)
+        self.reg(THIGH, val)
+        return val
+
+    def stealthchop(self, enable=True):
+        """ switches between StealthChop below TPWMTHRS (enable=True) and spreadCycle at all velocities
+            the datasheet only allows changing the chopper mode at standstill
+        """
+        gconf = self.reg(GCONF)
+        self.reg(GCONF, gconf | GCONF_EN_PWM_MODE if enable else gconf & ~GCONF_EN_PWM_MODE)
+
+    def chopper(self):
+        """ returns the chopper mode the driver currently uses, 'stealthChop' or 'spreadCycle'
+        """
+        return 'stealthChop' if self.reg(DRV_STATUS) & 0x4000 else 'spreadCycle'
+
+    def tstep(self):
+        """ returns the actual velocity [rotations/s] measured by the driver (TSTEP), 0 at standstill
+        """
+        t = self.reg(TSTEP)
+        return 0 if t >= 0xF_FFFF else rps(t, self._steps, self._fclk)
+
+    def strobe(self, position, callback=None, pin=None, interval=0.002):
+        """ arms the position compare (X_COMPARE) at position [microsteps] and returns a Strobe
+            that fires when the drive passes it: callback(strobe), strobe.wait() or `await strobe`
+            pin: GPIO connected to SWP_DIAG1 of the drive for hardware timing, None to poll every interval [s]
+            a drive has one X_COMPARE, arming a new strobe replaces the position of the previous one
+        """
+        return Strobe(self, position, callback, pin, interval)
+
+    def _set_pos(self, pos):
+        self.Pos = pos
+
+    def _set_target(self, pos):
+        self.TargetPos = pos % 2**32
+        return self.TargetPos
+
+    def duration(self, distance=None):
+        """ returns the predicted duration [s] of a positioning move over distance [microsteps]
+            from standstill with the ramp registers last written, by default of the last move
+        """
+        if distance is None:
+            distance = (self.TargetPos - self.Pos + 2**31) % 2**32 - 2**31
+        shadow = self.chain.shadow[self.motor_num]
+        params = {name: shadow.get(r, 0) for r, name in RAMP_REGS.items()}
+        return float(ramp.duration(distance, fclk=self._fclk, **params))
+
+    def speed_for(self, distance, duration, vmax=None):
+        """ returns the VMAX for a positioning move over distance [microsteps] from standstill that takes
+            duration [s] with the other ramp registers last written
+            vmax: the highest VMAX allowed, by default the VMAX of the motor (the one before stop())
+            raises ValueError if the move takes longer than duration even at vmax
+        """
+        shadow = self.chain.shadow[self.motor_num]
+        params = {name: shadow.get(r, 0) for r, name in RAMP_REGS.items() if r != VMAX}
+        if vmax is None:
+            vmax = self._vmax if self._vmax is not None else shadow.get(VMAX)
+        lo, hi = 0, min(vmax or 0x7F_FE00, 0x7F_FE00)  # VMAX < 2^23 - 512
+        t = float(ramp.duration(distance, vmax=hi, fclk=self._fclk, **params))
+        if t > duration:
+            raise ValueError(f'a move over {distance} microsteps takes {t:.3g} s > {duration:.3g} s at VMAX {hi}')
+        while hi - lo > 1:  # the duration decreases with VMAX
+            mid = (lo + hi) // 2
+            if ramp.duration(distance, vmax=mid, fclk=self._fclk, **params) > duration:
+                lo = mid
+            else:
+                hi = mid
+        return hi
+
+    def eta(self):
+        """ returns the predicted time.monotonic() of arrival of the last positioning move
+            or None if the motor was last moved at constant speed
+        """
+        if self.t_move is None or self.Pos is None:
+            return None
+        return self.t_move + self.duration()
+
+    def wait(self, timeout=None, margin=0.02, interval=0.002):
+        """ sleeps until margin [s] before the predicted arrival, then polls arrived() every interval [s]
+            returns True when the motor has arrived, False if timeout [s] has expired first
+        """
+        t_end = None if timeout is None else time.monotonic() + timeout
+        eta = self.eta()
+        if eta is not None:
+            dt = eta - margin - time.monotonic()
+            if t_end is not None:
+                dt = min(dt, t_end - time.monotonic())
+            if dt > 0:
+                time.sleep(dt)
+        while not self.arrived():
+            if t_end is not None and time.monotonic() > t_end:
+                return False
+            time.sleep(interval)
+        return True
+
     def moveby(self,
                relpos=None,  # [microsteps]
                speed=None  # [microstep/s]
@@ -198,20 +1362,7 @@ class Motor:
         # all arguments are optional
         # if only speed [rotations/s] is given, the sign determines the direction
         # if relpos is given, the sign of the optional speed is ignored
-        self.Pos = self.reg(XACTUAL)
-        if relpos is not None:
-            self.reg(RAMPMODE, 0)
-            if speed is not None:
-                self.reg(VMAX, abs(speed))
-            self.TargetPos = (self.Pos + relpos) % 2**32
-            self.reg(XTARGET, self.TargetPos)
-        elif speed is not None:
-            if speed < 0:
-                self.reg(RAMPMODE, 2)
-            else:
-                self.reg(RAMPMODE, 1)
-            self.reg(VMAX, abs(speed))
-        return self.Pos
+        return self.move(relpos=relpos, speed=speed)
 
     def moveto(self,
                abspos=None,  # [microsteps]
@@ -225,46 +1376,81 @@ class Motor:
         # all arguments are optional
         # if only speed [rotations/s] is given, the sign determines the direction
         # if abspos is given, the sign of the optional speed is ignored
-        self.Pos = self.reg(XACTUAL)
-        if abspos is not None:
-            self.reg(RAMPMODE, 0)
-            if speed is not None:
-                self.reg(VMAX, abs(speed))
-            self.TargetPos = abspos % 2**32
-            self.reg(XTARGET, self.TargetPos)
-        elif speed is not None:
-            if speed < 0:
-                self.reg(RAMPMODE, 2)
-            else:
-                self.reg(RAMPMODE, 1)
-            self.reg(VMAX, abs(speed))
-        return self.Pos
+        return self.move(abspos=abspos, speed=speed)
+
+    async def _wait(self, condition, timeout, eta=None):
+        return await asyncio.wait_for(self.chain.poller.wait(self.motor_num, condition, eta), timeout)
+
+    async def wait_arrived(self, timeout=None):
+        """ waits until the motor is at the target position, without blocking other tasks
+            returns the snapshot (status, XACTUAL, RAMP_STAT), raises asyncio.TimeoutError after timeout [s]
+        """
+        return await self._wait(lambda s, x, r: s & 0x20, timeout, self.eta())
+
+    async def wait_stopped(self, timeout=None):
+        """ waits until the motor is stopped, see wait_arrived()
+        """
+        return await self._wait(lambda s, x, r: s & 0x08, timeout, self.eta())
+
+    async def wait_switch_left(self, timeout=None):
+        """ waits until the left reference switch is active, see wait_arrived()
+        """
+        return await self._wait(lambda s, x, r: s & 0b0100_0000, timeout)
+
+    async def wait_switch_right(self, timeout=None):
+        """ waits until the right reference switch is active, see wait_arrived()
+        """
+        return await self._wait(lambda s, x, r: s & 0b1000_0000, timeout)
+
+    async def wait_stalled(self, timeout=None):
+        """ waits until StallGuard2 signals a stall, see wait_arrived()
+        """
+        return await self._wait(lambda s, x, r: s & 0x04, timeout)
+
+    async def amove(self, relpos=None, abspos=None, speed=None, timeout=None):
+        """ async variant of move(), returns the position before the move once the motor has arrived
+            moves at constant speed return right away
+        """
+        pos = self.move(relpos=relpos, abspos=abspos, speed=speed)
+        if relpos is not None or abspos is not None:
+            await self.wait_arrived(timeout)
+        return pos
+
+    async def amoveby(self, relpos=None, speed=None, timeout=None):
+        """ async variant of moveby(), see amove()
+        """
+        return await self.amove(relpos=relpos, speed=speed, timeout=timeout)
+
+    async def amoveto(self, abspos=None, speed=None, timeout=None):
+        """ async variant of moveto(), see amove()
+        """
+        return await self.amove(abspos=abspos, speed=speed, timeout=timeout)
 
     def status(self):
         """ updates self.Status with the current status byte and returns it
         """
-        self.reg(XACTUAL)
+        self.chain.snapshot()
         return self.Status
 
     def switch_left(self):
         """ updates self.Status with the current status byte
             returns True if the motor is stopped
         """
-        self.reg(XACTUAL)  # some read command to update the status
+        self.chain.snapshot()  # chain-wide status, reused for chain.max_age seconds
         return ((self.Status & 0b0100_0000) > 0)
 
     def switch_right(self):
         """ updates self.Status with the current status byte
             returns True if the motor is stopped
         """
-        self.reg(XACTUAL)  # some read command to update the status
+        self.chain.snapshot()  # chain-wide status, reused for chain.max_age seconds
         return ((self.Status & 0b1000_0000) > 0)
 
     def stopped(self):
         """ updates self.Status with the current status byte
             returns True if the motor is stopped
         """
-        self.reg(XACTUAL)  # some read command to update the status
+        self.chain.snapshot()  # chain-wide status, reused for chain.max_age seconds
         return ((self.Status & 0x08) > 0)
 
     def arrived(self):
@@ -272,7 +1458,7 @@ class Motor:
             returns True if the motor is at the target position
         """
 
-        self.reg(XACTUAL)  # some read command to update the status
+        self.chain.snapshot()  # chain-wide status, reused for chain.max_age seconds
         return ((self.Status & 0x20) > 0)
 
     def stalled(self):
@@ -280,7 +1466,7 @@ class Motor:
             returns True if ???
         """
 
-        self.reg(XACTUAL)  # some read command to update the status
+        self.chain.snapshot()  # chain-wide status, reused for chain.max_age seconds
         return ((self.Status & 0x04) > 0)
 
     def error(self):
@@ -288,16 +1474,40 @@ class Motor:
             returns True if the error bit is set
         """
 
-        self.reg(XACTUAL)  # some read command to update the status
+        self.chain.snapshot()  # chain-wide status, reused for chain.max_age seconds
         return ((self.Status & 0x02) > 0)
 
     def resetoccured(self):
         """ updates self.Status with the current status byte
             returns True if a reset has occurred
+            the chain recovers from resets on its own (see Chain.resets), after which the flag is cleared
         """
 
-        self.reg(XACTUAL)  # some read command to update the status
-        return ((self.Status & 0x02) > 0)
+        self.chain.snapshot()  # chain-wide status, reused for chain.max_age seconds
+        return ((self.Status & 0x01) > 0)
+
+    def events(self, clear=True):
+        """ returns the RAMP_STAT bits that are cleared upon read (see RAMP_STAT_EVENTS)
+            as collected by the chain snapshots since the last call
+        """
+        e = self.chain.events[self.motor_num]
+        if clear:
+            self.chain.events[self.motor_num] = 0
+        return e
+
+def motors(spi, chip_select, profiles, phase=1, polarity=1, baudrate=None, fclk=13e6, name=None, steps=200):
+    """ returns a list of Motor objects for all drives on a chain
+        profiles is a list with one profile per drive (see Chain.configure())
+        all drives are configured in one pipelined burst with a single verify pass
+        baudrate=None uses the baudrate characterized for the chain name (see Chain.characterize())
+    """
+    num = len(profiles)
+    chain = Chain.get(spi, chip_select, num, phase, polarity, baudrate, name)
+    with chain:
+        chain.configure(profiles)
+    return [Motor(spi, chip_select, num_of_motors=num, motor_num=i, phase=phase, polarity=polarity,
+                  baudrate=chain.baudrate, fclk=fclk, init=False, name=name, steps=steps) for i in range(num)]
+
 
 class Motors:
     """
@@ -306,20 +1516,22 @@ class Motors:
     """
 
 
-    def __init__(self, num, spi, chip_select, baudrate=100_000,
-                 fclk=13e6, steps=200, usteps=256):
+    def __init__(self, num, spi, chip_select, baudrate=None,
+                 fclk=13e6, steps=200, usteps=256, name=None):
         """
         :param num: int
         :param spi: busio.SPI object
         :param chip_select: digitalio.DigitalInOut object
-        :param baudrate: int, 4_000_000 max.
+        :param baudrate: int, 4_000_000 max., None loads the baudrate characterized for name (see Chain.characterize())
+        :param name: str, name of the chain, e.g. 'dock'
         :param autosend: bool, send each command automatically or accumulate for drives until send_now() is called
         """
         self.num_of_drives = num
         self.spi = spi
+        self.bus = Bus.get(spi)
         self.cs = chip_select
         self.cs.switch_to_output(True)  # initialize chipselect pin
-        self.baudrate = baudrate
+        self.baudrate = load_baudrate(name) if baudrate is None else baudrate
         self._fclk = fclk  # the clock frequency, ~13Mhz when using the internal clock
         self._steps = steps
         self._usteps = usteps
@@ -328,12 +1540,18 @@ class Motors:
             pass
         self.Status = [-1] * self.num_of_drives
         self.xtarget = [None] * self.num_of_drives
-        self.format = ['>BL'] * self.num_of_drives
         self.reply = [0x00] * self.num_of_drives
-        self.inbuf = bytearray(b'\x00' * PKTLEN * self.num_of_drives)
-        self.outbuf = bytearray(b'\x00' * PKTLEN * self.num_of_drives)
-        self.outbuf2 = bytearray('\x00' * PKTLEN * self.num_of_drives)
+        self.inbuf = bytearray(PKTLEN * self.num_of_drives)
+        self.outbuf = bytearray(PKTLEN * self.num_of_drives)
+        self.outbuf2 = bytearray(PKTLEN * self.num_of_drives)  # reads GCONF to collect the replies
+        # data bytes of each drive's datagram, for comparing echoes in place
+        self._out_data = [memoryview(self.outbuf)[i + 1:i + PKTLEN] for i in range(0, len(self.outbuf), PKTLEN)]
+        self._in_data = [memoryview(self.inbuf)[i + 1:i + PKTLEN] for i in range(0, len(self.inbuf), PKTLEN)]
         self.txerror = 0
+        self.ramp = [{} for _ in range(self.num_of_drives)]  # ramp registers last written, see RAMP_REGS
+        self._unscaled = [{} for _ in range(self.num_of_drives)]  # ramp registers replaced by a synchronized move
+        self.t_move = None  # time.monotonic() when the last positioning move was sent
+        self.durations = [None] * self.num_of_drives  # predicted durations [s] of the last positioning move
         self.xactual = self.reg(XACTUAL)
         self.rampmode = self.reg(RAMPMODE)
 
@@ -350,20 +1568,16 @@ class Motors:
         self.reg(DMAX, 50000)
         self.reg(D1, 5000)
         self.reg(VSTOP, 10)
-        self.moveby(speed=[0,0])
+        self.moveby(speed=[0] * self.num_of_drives)
 
 
     def __enter__(self):
-        while self.spi.try_lock():
-            pass
-        while self.spi.try_lock():
-            pass
-        self.spi.configure(phase=1, polarity=1, baudrate=self.baudrate)
+        self.bus.acquire(1, 1, self.baudrate)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self.cs: self.cs.value = True
-        self.spi.unlock()
+        self.bus.release()
 
     def write_read(self,outbuf, inbuf):
         self.cs.value = False
@@ -379,21 +1593,42 @@ class Motors:
             if a value is given, it is written to the register
             self.Status is updated with the current status byte
         """
-        if val is None:
-            val = [None] * self.num_of_drives
-        elif type(val) is int:
-            val = [val] * self.num_of_drives
-        elif len(val) != self.num_of_drives:
-            raise ValueError(f"length of ({len(val)}) does not match number of drives ({self.num_of_drives})")
-
-        self.format = '>Bl' if signed else '>BL' # format string for signed long
-        for i, v in enumerate(val):
-            struct.pack_into(self.format,
-                             self.outbuf,
-                             i * PKTLEN,
-                             regnum | (0x00 if v is None else 0x80),
-                             0 if v is None else v
-                             )
+        self.reg_into(self.reply, regnum, val, signed)
+        return self.reply.copy()
+
+    def reg_into(self,
+                 out,
+                 regnum,
+                 val=None,
+                 signed=False,
+                 status=None
+                 ):
+        """ like reg(), but writes the replies into the caller-supplied sequence out (a list or an
+            array.array('l') if signed, 'L' otherwise) and the status bytes into status (self.Status by default)
+            val is None for a read, an int for all drives or a sequence with one value or None per drive
+            the datagrams are packed into and compared in the preallocated buffers, so polling with a
+            read allocates no lists or buffers
+            returns out
+        """
+        n = self.num_of_drives
+        if val is not None and type(val) is not int and len(val) != n:
+            raise ValueError(f"length of ({len(val)}) does not match number of drives ({n})")
+        if status is None:
+            status = self.Status
+        if regnum in RAMP_REGS and val is not None:
+            for i in range(n):
+                v = val if type(val) is int else val[i]
+                if v is not None:
+                    self.ramp[i][regnum] = v
+                    self._unscaled[i].pop(regnum, None)
+
+        datagram = DATAGRAM_SIGNED if signed else DATAGRAM
+        for i in range(n):
+            v = val if val is None or type(val) is int else val[i]
+            if v is None:
+                datagram.pack_into(self.outbuf, i * PKTLEN, regnum, 0)
+            else:
+                datagram.pack_into(self.outbuf, i * PKTLEN, regnum | 0x80, v)
 
         if DEBUG: print('   ', end=' ')
         with self:
@@ -401,25 +1636,46 @@ class Motors:
             if DEBUG: ob = ' x'.join(f'{o:02X}' for o in self.outbuf); print(f"{ob:56}", end='  ')
             self.write_read(self.outbuf2, self.inbuf)  # read
         if DEBUG: ib = ' x'.join(f'{i:02X}' for i in self.inbuf); print(f"{ib:56}", end='  ')
-        for drive in range(self.num_of_drives):
-            if self.outbuf[drive * PKTLEN] & 0x80 :
-                i = drive * PKTLEN
-                self.txerror += 1 if (self.inbuf[i+1:i+5] != self.outbuf[i+1:i+5]) else 0
-            self.Status[drive], self.reply[drive] = struct.unpack_from(self.format, self.inbuf, drive * PKTLEN)
-            if DEBUG: print(f"{self.Status[drive]:08b}", end='  ')
-            if DEBUG: print(f"{self.reply[drive]:10d}", end='  ')
+        retry = 0  # bit mask of the drives whose write echo does not match
+        for i in range(n):
+            if self.outbuf[i * PKTLEN] & 0x80 and self._in_data[i] != self._out_data[i]:
+                self.txerror += 1
+                retry |= 1 << i
+            status[i], out[i] = datagram.unpack_from(self.inbuf, i * PKTLEN)
+            if DEBUG: print(f"{status[i]:08b}", end='  ')
+            if DEBUG: print(f"{out[i]:10d}", end='  ')
         if DEBUG: print(f"txerror: {self.txerror}")
-        self.outbuf[:] = bytearray('\x00' * PKTLEN * self.num_of_drives)
-        return self.reply.copy()
+
+        # send only the datagrams of those drives again, the others read GCONF
+        tries = 0
+        while retry and tries < RETRIES:
+            tries += 1
+            for i in range(n):
+                if not retry >> i & 1:
+                    DATAGRAM.pack_into(self.outbuf, i * PKTLEN, GCONF, 0)
+            with self:
+                self.write_read(self.outbuf, self.inbuf)
+                self.write_read(self.outbuf2, self.inbuf)
+            for i in range(n):
+                if retry >> i & 1:
+                    if self._in_data[i] == self._out_data[i]:
+                        retry &= ~(1 << i)
+                    else:
+                        self.txerror += 1
+                    status[i], out[i] = datagram.unpack_from(self.inbuf, i * PKTLEN)
+        return out
 
     def move(self,
              relpos=None,  # [microsteps]
              abspos=None,  # [microsteps]
-             speed=None    # [microstep/s]
+             speed=None,   # [microstep/s]
+             sync=False
              ):
         """ moves the motor to a relative or absolute position at the speed given
             updates self.Status with the current status byte
             returns the position before the move
+            with sync=True the positioning moves of all drives arrive at the same time (see _sync())
+            the targets of all drives are written in one frame, so the drives also start together
         """
         # moves the motor and returns the status and the current position
         # all arguments are optional
@@ -430,26 +1686,115 @@ class Motors:
         self.xtarget = self.reg(XTARGET, signed=True)
         self.rampmode = self.reg(RAMPMODE)
 
-        if relpos is not None:
-            if speed is not None:
-                self.reg(VMAX, [abs(int(s)) if s is not None else None for s in speed])
-            self.rampmode = self.reg(RAMPMODE, [0 if p is not None else None for p in relpos])
-            self.xtarget = [((self.xactual[i] + int(p)) % 0x1000_0000) if p is not None else None for i, p in enumerate(relpos)]
-            self.reg(XTARGET, self.xtarget)
-        elif abspos is not None:
-            if speed is not None:
-                self.reg(VMAX, [abs(int(s)) if s is not None else None for s in speed])
-            self.reg(RAMPMODE, [0 if p is not None else None for p in abspos])
-            self.xtarget = [(int(p) % 0x1_0000_0000) if p is not None else None for i, p in enumerate(abspos)]
+        if relpos is not None or abspos is not None:
+            if relpos is not None:
+                targets = [((self.xactual[i] + int(p)) % 0x1_0000_0000) if p is not None else None for i, p in enumerate(relpos)]
+            else:
+                targets = [(int(p) % 0x1_0000_0000) if p is not None else None for p in abspos]
+            vmax = None if speed is None else [abs(int(s)) if s is not None else None for s in speed]
+            if sync:
+                self._sync(targets, vmax)
+            else:
+                self._restore(vmax)
+            self.rampmode = self.reg(RAMPMODE, [0 if t is not None else None for t in targets])
+            self.xtarget = targets
             self.reg(XTARGET, self.xtarget)
+            self.t_move = time.monotonic()
+            self.durations = [self._duration(self._distance(i, t), self.ramp[i]) if t is not None else None
+                              for i, t in enumerate(targets)]
         elif speed is not None:
-            self.reg(VMAX, [abs(s) if s is not None else None for s in speed])
+            self._restore([abs(s) if s is not None else None for s in speed])
             self.reg(RAMPMODE, [(2 if s < 0 else 1) if s is not None else None for s in speed])
+            self.t_move = None
         return self.xactual
 
+    def _distance(self, drive, target):
+        return (target - self.xactual[drive] + 2**31) % 2**32 - 2**31
+
+    def _duration(self, distance, regs):
+        params = {name: regs.get(r, 0) for r, name in RAMP_REGS.items()}
+        return float(ramp.duration(distance, fclk=self._fclk, **params))
+
+    def _restore(self, vmax=None):
+        """ writes back the ramp registers replaced by a synchronized move and VMAX if given
+            one frame per register for all drives
+        """
+        vals = {r: [u.get(r) for u in self._unscaled] for r in RAMP_REGS}
+        if vmax is not None:
+            vals[VMAX] = [v if v is not None else vals[VMAX][i] for i, v in enumerate(vmax)]
+        for r, v in vals.items():
+            if any(x is not None for x in v):
+                self.reg(r, v)
+
+    def _sync(self, targets, vmax=None):
+        """ writes the ramp registers of a synchronized move to targets
+            the drive with the longest predicted move (the leader) keeps its ramp, the others get the ramp of
+            the leader scaled by their distance ratio, so all positions are the same fraction of the way at any
+            time and all drives arrive together
+            the replaced registers are restored by the next move without sync
+        """
+        n = self.num_of_drives
+        dist = [self._distance(i, t) if t is not None else 0 for i, t in enumerate(targets)]
+        nominal = []
+        for i in range(n):
+            regs = {r: self._unscaled[i].get(r, self.ramp[i].get(r, 0)) for r in RAMP_REGS}
+            if vmax is not None and vmax[i] is not None:
+                regs[VMAX] = vmax[i]
+            nominal.append(regs)
+        moving = [i for i in range(n) if dist[i]]
+        if not moving:
+            return self._restore(vmax)
+        lead = max(moving, key=lambda i: self._duration(dist[i], nominal[i]))
+
+        vals = {r: [None] * n for r in RAMP_REGS}
+        for i in range(n):
+            if i in moving:
+                k = abs(dist[i]) / abs(dist[lead])
+                regs = {r: max(1, round(v * k)) if v else 0 for r, v in nominal[lead].items()}
+            else:
+                regs = nominal[i]  # a drive without a move runs its own ramp
+            for r, v in regs.items():
+                if v != self.ramp[i].get(r):
+                    vals[r][i] = v
+        for r, v in vals.items():
+            if any(x is not None for x in v):
+                self.reg(r, v)
+        for i in range(n):
+            for r, v in nominal[i].items():
+                if self.ramp[i].get(r) != v:
+                    self._unscaled[i][r] = v
+
+    def eta(self, drives=None):
+        """ returns the predicted time.monotonic() of arrival of the last positioning move of the drives
+            or None if the motors were last moved at constant speed
+        """
+        durations = [d for i, d in enumerate(self.durations) if d is not None and (drives is None or i in drives)]
+        if self.t_move is None or not durations:
+            return None
+        return self.t_move + max(durations)
+
+    def wait(self, drives=None, timeout=None, margin=0.02, interval=0.002):
+        """ sleeps until margin [s] before the predicted arrival, then polls arrived() every interval [s]
+            returns True when the drives have arrived, False if timeout [s] has expired first
+        """
+        t_end = None if timeout is None else time.monotonic() + timeout
+        eta = self.eta(drives)
+        if eta is not None:
+            dt = eta - margin - time.monotonic()
+            if t_end is not None:
+                dt = min(dt, t_end - time.monotonic())
+            if dt > 0:
+                time.sleep(dt)
+        while not self.arrived(drives):
+            if t_end is not None and time.monotonic() > t_end:
+                return False
+            time.sleep(interval)
+        return True
+
     def moveby(self,
                relpos=None,  # [microsteps]
                speed=None,  # [microstep/s]
+               sync=False
                ):
         """ moves the motor to a relative or absolute position at the speed given
             updates self.Status with the current status byte
@@ -459,11 +1804,12 @@ class Motors:
         # all arguments are optional
         # if only speed [rotations/s] is given, the sign determines the direction
         # if relpos is given, the sign of the optional speed is ignored
-        return self.move(relpos=relpos, speed=speed)
+        return self.move(relpos=relpos, speed=speed, sync=sync)
 
     def moveto(self,
                abspos=None,  # [microsteps]
-               speed=None  # [microstep/s]
+               speed=None,  # [microstep/s]
+               sync=False
                ):
         """ moves the motor to a relative or absolute position at the speed given
             updates self.Status with the current status byte
@@ -473,69 +1819,298 @@ class Motors:
         # all arguments are optional
         # if only speed [rotations/s] is given, the sign determines the direction
         # if abspos is given, the sign of the optional speed is ignored
-        return self.move(abspos=abspos, speed=speed)
+        return self.move(abspos=abspos, speed=speed, sync=sync)
 
 
     def status(self):
         """ updates self.Status with the current status byte and returns it
         """
-        self.reg(XACTUAL)
+        self.reg_into(self.reply, XACTUAL)
         return self.Status
 
+    def _all(self, mask, drives=None):
+        # True if the status bits in mask are set for all drives, without building lists
+        for i in range(self.num_of_drives):
+            if (drives is None or i in drives) and not self.Status[i] & mask:
+                return False
+        return True
+
+    def _any(self, mask, drives=None):
+        # True if the status bits in mask are set for any drive, without building lists
+        for i in range(self.num_of_drives):
+            if (drives is None or i in drives) and self.Status[i] & mask:
+                return True
+        return False
+
     def stopped(self, drives=None):
         """ updates self.Status with the current status byte
             returns True if the motor is stopped
         """
-        self.reg(XACTUAL)  # some read command to update the status
-        return all([s & 0x08 for i,s in enumerate(self.Status) if drives is None or i in drives])
+        self.reg_into(self.reply, XACTUAL)  # some read command to update the status
+        return self._all(0x08, drives)
 
     def arrived(self, drives=None):
         """ updates self.Status with the current status byte
             returns True if the motor is at the target position
         """
 
-        self.reg(XACTUAL)  # some read command to update the status
-        return all([s & 0x20 for i,s in enumerate(self.Status) if drives is None or i in drives])
+        self.reg_into(self.reply, XACTUAL)  # some read command to update the status
+        return self._all(0x20, drives)
 
     def stalled(self, drives=None):
         """ updates self.Status with the current status byte
             returns True if ???
         """
 
-        self.reg(XACTUAL)  # some read command to update the status
-        return any([s & 0x04 for i,s in enumerate(self.Status) if drives is None or i in drives])
+        self.reg_into(self.reply, XACTUAL)  # some read command to update the status
+        return self._any(0x04, drives)
 
     def error(self, drives=None):
         """ updates self.Status with the current status byte
             returns True if the error bit is set
         """
 
-        self.reg(XACTUAL)  # some read command to update the status
-        return any([s & 0x02 for i,s in enumerate(self.Status) if drives is None or i in drives])
+        self.reg_into(self.reply, XACTUAL)  # some read command to update the status
+        return self._any(0x02, drives)
 
     def resetoccured(self, drives=None):
         """ updates self.Status with the current status byte
             returns True if a reset has occurred
         """
 
-        self.reg(XACTUAL)  # some read command to update the status
-        return any([s & 0x02 for i,s in enumerate(self.Status) if drives is None or i in drives])
+        self.reg_into(self.reply, XACTUAL)  # some read command to update the status
+        return self._any(0x01, drives)
 
 
     def TPWMTHRS(self, rps=None, drives=None):  # upper limit for stealth chop in rps
-        pass
+        """ sets the velocity [rotations/s] above which the drives change from StealthChop to spreadCycle
+            rps is a number for all drives or a list with one per drive, None: StealthChop at all velocities
+            drives: list of the drives to set, None for all
+            returns the register values
+        """
+        return self._threshold(TPWMTHRS, rps, drives)
+
+    def THIGH(self, rps=None, drives=None):
+        """ sets the velocity [rotations/s] above which the drives use the high velocity chopper mode
+            see TPWMTHRS()
+        """
+        return self._threshold(THIGH, rps, drives)
+
+    def _threshold(self, regnum, rps, drives):
+        if type(rps) not in (list, tuple):
+            rps = [rps] * self.num_of_drives
+        val = [tstep(r, self._steps, self._fclk) if drives is None or i in drives else None for i, r in enumerate(rps)]
+        self.reg(regnum, val)
+        return val
+
+    def stealthchop(self, enable=True, drives=None):
+        """ switches the drives between StealthChop below TPWMTHRS (enable=True) and spreadCycle at all velocities
+            the datasheet only allows changing the chopper mode at standstill
+        """
+        gconf = self.reg(GCONF)
+        self.reg(GCONF, [(g | GCONF_EN_PWM_MODE if enable else g & ~GCONF_EN_PWM_MODE) if drives is None or i in drives else None
+                         for i, g in enumerate(gconf)])
 
 class Pump(Motor):
     """ takes driver/micro steps per milliliter as an initialization argument
         (remains accessible as F)
+        volumes are in mL, flow rates in µL/min
+        TotalP and TotalM are the volumes [mL] pumped in the positive and in the negative direction
+        with a calibration (pump_calibration.Calibration), the microsteps/mL depend on the flow rate
     """
-    def __init__(self, stepspermilliliter):
+    # [microsteps] longer dispenses run in velocity mode until this far from the end (~0.07 mL at 1e6 microsteps/mL)
+    # a dispense raises it to what it covers in 4 position checks plus its deceleration, so it never overshoots
+    HANDOVER = 2**16
+    STALL = 0.5  # [s] at standstill without progress after which a dispense ends short
+
+    def __init__(self, stepspermilliliter, spi, chip_select, profile='syringe-pump', interval=0.05, calibration=None,
+                 **kwargs):
         """ initializes the TMC5130
             sets the volume/step conversion factor
-            zeroes the positive and negative totals and the position
+            zeroes the positive and negative totals
+            :param stepspermilliliter: float, nominal microsteps/mL
+            :param interval: float, time [s] between the position checks of a dispense
+            :param calibration: pump_calibration.Calibration object, None uses stepspermilliliter at all rates
+            the other arguments are passed to Motor
         """
         self.F = stepspermilliliter
         self.TotalP = 0
         self.TotalM = 0
-        Motor.__init__(self)
-        self.Oldpos = self.move(relpos=0)
\ No newline at end of file
+        self.interval = interval
+        self.calibration = calibration
+        self.job = None  # the last Dispense
+        Motor.__init__(self, spi, chip_select, profile=profile, **kwargs)
+        self.Oldpos = self.reg(XACTUAL)
+
+    def steps_per_ml(self, flow):
+        """ returns the microsteps/mL at flow [µL/min], from the calibration if there is one
+        """
+        if self.calibration is None:
+            return self.F
+        return float(self.calibration.steps_per_ml(flow))
+
+    def vmax(self, flow, spm=None):
+        """ returns the VMAX register value for flow [µL/min]
+            spm: microsteps/mL, by default those at flow
+            raises ValueError if the flow needs more than the highest VMAX
+        """
+        if spm is None:
+            spm = self.steps_per_ml(flow)
+        vmax = int(ramp.velocity_reg(abs(flow) / 1000 / 60 * spm, self._fclk))
+        if vmax > 0x7F_FE00:  # VMAX < 2^23 - 512
+            raise ValueError(f'flow {flow} µL/min needs VMAX {vmax} > {0x7F_FE00}')
+        return vmax
+
+    def track(self, spm=None):
+        """ reads XACTUAL and adds the volume pumped since the last call to TotalP or TotalM
+            spm: microsteps/mL of the running dispense, F by default
+            returns the distance [microsteps] moved since the last call
+        """
+        if spm is None:
+            spm = self.F
+        x = self.reg(XACTUAL)
+        d = (x - self.Oldpos + 2**31) % 2**32 - 2**31
+        self.Oldpos = x
+        if d > 0:
+            self.TotalP += d / spm
+        else:
+            self.TotalM -= d / spm
+        return d
+
+    def busy(self):
+        """ returns True while a dispense is running
+        """
+        return self.job is not None and self.job.running()
+
+    def dispense(self, volume, flow):
+        """ starts pumping volume [mL] at flow [µL/min] and returns the Dispense without waiting
+            the sign of volume gives the direction
+            raises RuntimeError if the pump is busy, ValueError if flow is too high (see vmax())
+        """
+        if self.busy():
+            raise RuntimeError('pump is busy')
+        self.job = Dispense(self, volume, flow)
+        return self.job
+
+    def pump(self, volume, flow):
+        """ pumps volume [mL] at flow [µL/min] and waits until it has been dispensed
+            returns the volume [mL] dispensed
+        """
+        job = self.dispense(volume, flow)
+        job.wait()
+        return job.dispensed()
+
+
+class Dispense:
+    """
+    a volume being pumped by a Pump, started by Pump.dispense()
+    the stroke is one positioning move, a stroke longer than Pump.HANDOVER runs in velocity mode and
+    is handed over to the ramp generator in position mode near its end, so it decelerates onto the end
+    position without stopping in between
+    the volume dispensed is tracked from XACTUAL by a background thread
+    a stroke that ends early, because the drive was stopped (e.g. Pump.stop(), a stop switch) or reset,
+    ends the dispense short: self.short is set and self.error is a RuntimeError raised by wait()
+    """
+
+    def __init__(self, pump, volume, flow):
+        """
+        :param pump: Pump object
+        :param volume: float, mL, the sign gives the direction
+        :param flow: float, µL/min
+        """
+        self.pump = pump
+        self.volume = volume
+        self.flow = abs(flow)
+        self.spm = pump.steps_per_ml(self.flow)  # microsteps/mL at this flow, looked up once
+        self.vmax = pump.vmax(self.flow, self.spm)  # raises ValueError before the thread starts
+        self.steps = int(round(volume * self.spm))
+        self.moved = 0  # microsteps since the start
+        self.error = None
+        self.short = False  # the stroke ended before the volume was dispensed, without cancel()
+        self.cancelled = False
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        p = self.pump
+        vmax = self.vmax
+        v = float(ramp.velocity(vmax, p._fclk))
+        dmax = p.chain.shadow[p.motor_num].get(DMAX) or PROFILE_DEFAULT[DMAX]
+        handover = max(p.HANDOVER, int(4 * p.interval * v + v**2 / (2 * float(ramp.acceleration(dmax, p._fclk)))))
+        resets = p.chain.resets[p.motor_num]
+        try:
+            p.track()
+            positioning = abs(self.steps) <= handover
+            if positioning:
+                p.move(abspos=(p.Oldpos + self.steps) % 2**32, speed=vmax)
+            else:
+                p.move(speed=vmax if self.steps > 0 else -vmax)
+            t_progress = time.monotonic()
+            while not self.cancelled:
+                time.sleep(p.interval)
+                d = p.track(self.spm)
+                self.moved += d
+                rest = self.steps - self.moved
+                now = time.monotonic()
+                if d:
+                    t_progress = now
+                if p.Status & 0x01 or p.chain.resets[p.motor_num] != resets:
+                    # XACTUAL restarted at 0, the jump is not a volume
+                    self.moved -= d
+                    if d > 0:
+                        p.TotalP -= d / self.spm
+                    else:
+                        p.TotalM += d / self.spm
+                    self.short = True
+                    raise RuntimeError(f'pump driver reset during dispense, {self.remaining():.4f} mL not dispensed')
+                if rest and p.Status & 0x28 and now - t_progress > p.STALL:  # standstill or position_reached
+                    self.short = True
+                    raise RuntimeError(f'pump stopped during dispense, {self.remaining():.4f} mL not dispensed')
+                if not positioning and abs(rest) <= handover:
+                    # target first, then the mode, so the ramp continues towards it
+                    target = (p.Oldpos + rest) % 2**32
+                    p.chain.submit(p.motor_num, XTARGET, target)
+                    p.chain.submit(p.motor_num, RAMPMODE, 0)
+                    p.chain.flush(echo=False, priority=p.priority)
+                    p.Pos, p.TargetPos, p.t_move = p.Oldpos, target, time.monotonic()
+                    positioning = True
+                elif positioning and rest == 0:
+                    break
+            self.moved += p.track(self.spm)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done.set()
+
+    def running(self):
+        """ returns True until the volume has been dispensed or the dispense was cancelled
+        """
+        return not self.done.is_set()
+
+    def dispensed(self):
+        """ returns the volume [mL] dispensed so far
+        """
+        return self.moved / self.spm
+
+    def remaining(self):
+        """ returns the volume [mL] still to be dispensed
+        """
+        return (self.steps - self.moved) / self.spm
+
+    def wait(self, timeout=None):
+        """ blocks until the dispense has ended, returns False if timeout [s] has expired first
+            raises the exception that ended the dispense, if any
+        """
+        if not self.done.wait(timeout):
+            return False
+        if self.error is not None:
+            raise self.error
+        return True
+
+    def cancel(self):
+        """ stops the pump and ends the dispense, the volume dispensed stays in dispensed()
+        """
+        self.cancelled = True
+        self.pump.stop()
+        self.thread.join()
@@ -1,3 +1,55 @@
+import threading
+import time
+import lis_circuitpython_tmc5130 as tmc
+import pump_calibration
+import chamber_presence
+
+DOCKS = (1, 2, 3, 4)  # dock slot numbers, in the order of the drives on the SPI daisy chain
+USTEPS_PER_DEGREE = 532_480 / 360  # chamber tilt, microsteps/°
+PUMP_USTEPS_PER_ML = 1_000_000  # syringe pump, nominal microsteps/mL used until calibrated
+
+_docks = None
+_pump = None
+_presence = None
+agitator = tmc.Agitator()  # rocks the chambers for mix_chamber()
+
+
+def docks():
+    """ returns the tilt motors of the docks, configuring the chain on first use
+    """
+    global _docks
+    if _docks is None:
+        import conf  # sets up the hardware
+        _docks = tmc.motors(conf.spi_dock, conf.cs_dock, ['dock-tilt'] * len(DOCKS), name='dock',
+                           baudrate=tmc.load_baudrate('dock', default=500_000))
+    return _docks
+
+
+def syringe_pump():
+    """ returns the syringe pump, configuring it on first use
+    """
+    global _pump
+    if _pump is None:
+        import conf  # sets up the hardware
+        calibration = pump_calibration.Calibration('pump', default=PUMP_USTEPS_PER_ML)
+        _pump = tmc.Pump(PUMP_USTEPS_PER_ML, conf.spi_pump, conf.cs_pump, name='pump', phase=0, polarity=0,
+                         baudrate=tmc.load_baudrate('pump', 0, 0, default=250_000),
+                         calibration=calibration)
+    return _pump
+
+
+def presence():
+    """ returns the running chamber_presence.PresenceMonitor of the chambers, starting it on first use
+        e.g. presence().present('A') or await presence().changed('A', chamber_presence.INSERTED)
+    """
+    global _presence
+    if _presence is None:
+        import conf  # sets up the hardware
+        _presence = chamber_presence.PresenceMonitor(conf.i2c_chambers, conf.chambers_adresses)
+        _presence.start()
+    return _presence
+
+
 def mount_chamber(slot):
     ...
 # got to home position
@@ -7,12 +59,22 @@ def mount_chamber(slot):
 def tilt_chamber(slot, angle):
     ...
     if type(angle) is bool:
-        angle = 90 if angle else angle = 0
+        angle = 90 if angle else 0
 
     # got to angle
 
-def mix_chamber(slot, speed):
-    ...
+def mix_chamber(slot, speed, amplitude=10):
+    """ rocks the chamber in slot around its current angle by +/- amplitude [°]
+        speed: rocking cycles/minute, 0 or None stops mixing after the current stroke and returns the chamber
+        to the centre angle
+        the strokes run on the ramp generator of the motor, see tmc.Agitator
+        raises ValueError if the motor cannot rock that fast
+    """
+    motor = docks()[DOCKS.index(slot)]
+    if not speed:
+        agitator.stop(motor)
+    else:
+        agitator.start(motor, amplitude * USTEPS_PER_DEGREE, 60 / speed)
 
 def switch_inlet(inlet):
     ...
@@ -21,7 +83,10 @@ def switch_outlet(outlet):
     ...
 
 def pump(volume, rate):
-    ...
+    """ starts pumping volume [mL] at rate [µL/min] with the syringe pump
+        returns the tmc.Dispense job without waiting for it
+    """
+    return syringe_pump().dispense(volume, rate)
 
 class ChamberParameterList:
     ...
@@ -55,7 +120,169 @@ class OutputValve:
 
 class Pump:
 
-    def __init__(self):
-        ...
+    def __init__(self, motor=None):
+        """ :param motor: tmc.Pump object, the syringe pump by default
+        """
+        self.motor = syringe_pump() if motor is None else motor
+
+    def busy(self):
+        return self.motor.busy()
+
+    def pump(self, volume, flow):
+        """ starts pumping volume [mL] at flow [µL/min], returns the tmc.Dispense job
+        """
+        return self.motor.dispense(volume, flow)
+
+
+class FlowSensor:
+    """ the SLF3S-1300F liquid flow sensor, flows in µL/min
+    """
+
+    def __init__(self, i2c=None, liquid='h2o'):
+        """ :param i2c: busio.I2C object, the flow sensor bus of conf by default
+            :param liquid: str, 'h2o' or 'ipa' calibration of the sensor
+        """
+        import slf3s_jad
+        if i2c is None:
+            import conf  # sets up the hardware
+            i2c = conf.i2c_flow_sensor
+        self.sensor = slf3s_jad.SLF3S_1300(i2c, liquid)
+
+    def flow(self):
+        """ returns the flow [µL/min]
+        """
+        return self.sensor.read_flow() * 1000  # mL/min
+
+    def temperature(self):
+        """ returns the temperature [°C] of the liquid
+        """
+        return self.sensor.read_temp()
+
+
+class DosingController:
+    """ doses measured volumes: the pump runs until the flow integrated from the flow sensor reaches the target
+        the pump is stopped early by the volume that still flows after a stop (overshoot), which is learned
+        from every dose as a lag time [s] of the flow, and a dose that is short once the flow has settled
+        after a stroke is topped up
+        the first stroke is the volume by the steps, the top ups together deliver at most (overrun - 1) * volume
+        more, a dose whose measured volume falls below plausibility * the volume pumped by the steps
+        (e.g. a dead sensor) or still misses more than tolerance at the end ends with an error
+    """
+
+    def __init__(self, pump, sensor, interval=0.01, overrun=1.2, lag=0.05, settle=0.5, alpha=0.5,
+                 tolerance=0.001, topups=3, record=True, plausibility=0.5):
+        """ :param pump: tmc.Pump object
+            :param sensor: FlowSensor object
+            :param interval: float, sampling interval [s] of the flow
+            :param overrun: float, limit of all strokes of a dose including top ups, relative to the volume
+            :param lag: float, initial overshoot [s of flow at the time of the stop]
+            :param settle: float, time [s] the flow is still integrated after a stroke before it is topped up
+            :param alpha: float, weight of the last dose in the learned lag
+            :param tolerance: float, volume [mL] that may be missing at the end of a stroke or the dose
+            :param topups: int, maximum number of top up strokes per dose
+            :param record: bool, add every dose to the calibration of the pump
+            :param plausibility: float, least ratio of measured volume to the volume pumped by the steps
+        """
+        self.pump = pump
+        self.sensor = sensor
+        self.interval = interval
+        self.overrun = overrun
+        self.lag = lag
+        self.settle = settle
+        self.alpha = alpha
+        self.tolerance = tolerance
+        self.topups = topups
+        self.record = record
+        self.plausibility = plausibility
+
+    def dose(self, volume, flow):
+        """ starts dosing volume [mL] at flow [µL/min] and returns the Dose without waiting
+        """
+        return Dose(self, volume, flow)
+
+
+class Dose:
+    """ a volume being dosed by a DosingController
+    """
+
+    def __init__(self, controller, volume, flow):
+        self.controller = controller
+        self.volume = volume
+        self.flow = abs(flow)
+        self.measured = 0  # volume [mL] integrated from the flow sensor
+        self.steps = 0  # microsteps pumped
+        self.error = None
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        c = self.controller
+        sign = 1 if self.volume > 0 else -1
+        target = abs(self.volume)
+        topups = 0
+        stopped = None  # (volume, flow) when the pump was stopped on the volume
+        spm = c.pump.steps_per_ml(self.flow)
+        budget = c.overrun * target  # volume [mL] all strokes may deliver by their steps
+        try:
+            job = c.pump.dispense(self.volume, self.flow)
+            t, f = time.monotonic(), sign * c.sensor.flow()
+            t_end = None  # end of the settling after a stroke
+            while True:
+                time.sleep(c.interval)
+                now, f1 = time.monotonic(), sign * c.sensor.flow()
+                self.measured += (f + f1) / 2 * (now - t) / 60_000  # µL/min * s -> mL
+                t, f = now, f1
+                if t_end is not None:
+                    if t < t_end:
+                        continue
+                    if stopped is not None:  # the steps of the deceleration after cancel(), now at standstill
+                        d = c.pump.track(job.spm)
+                        job.moved += d
+                        self.steps += abs(d)
+                        if stopped[1] > 0:  # learn the overshoot
+                            lag = (self.measured - stopped[0]) * 60_000 / stopped[1]
+                            c.lag += c.alpha * (lag - c.lag)
+                        stopped = None
+                    pumped = self.steps / spm
+                    if self.measured < c.plausibility * pumped - c.tolerance:
+                        raise RuntimeError(f'flow sensor measured {self.measured:.4f} mL of {pumped:.4f} mL pumped')
+                    rest = min(target - self.measured, budget - pumped)
+                    if rest <= c.tolerance or topups >= c.topups:
+                        break
+                    job = c.pump.dispense(sign * rest, self.flow)
+                    topups += 1
+                    t_end = None
+                elif self.measured + max(f, 0) * c.lag / 60_000 >= target:
+                    job.cancel()
+                    self.steps += abs(job.moved)
+                    stopped = (self.measured, f)
+                    t_end = t + c.settle
+                elif not job.running():  # the stroke ended before the sensor reached the volume
+                    self.steps += abs(job.moved)
+                    job.wait()  # raises if the pump stopped short
+                    t_end = t + c.settle
+            if target - self.measured > c.tolerance:
+                raise RuntimeError(f'dosed {self.measured:.4f} mL of {target:.4f} mL, '
+                                   f'{target - self.measured:.4f} mL missing after {topups} top ups')
+            if c.record and c.pump.calibration is not None and self.steps and self.measured > 0:
+                c.pump.calibration.record(self.flow, self.steps, self.measured)
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done.set()
 
+    def running(self):
+        """ returns True until the dose has ended
+        """
+        return not self.done.is_set()
 
+    def wait(self, timeout=None):
+        """ blocks until the dose has ended, returns False if timeout [s] has expired first
+            raises the exception that ended the dose, if any
+        """
+        if not self.done.wait(timeout):
+            return False
+        if self.error is not None:
+            raise self.error
+        return True
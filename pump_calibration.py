@@ -0,0 +1,98 @@
+'''
+rate-dependent calibration of the pumps
+records the volume measured (e.g. with the SLF3S flow sensor) against the microsteps commanded at a flow rate
+and answers microsteps/mL at any flow rate by interpolating over log(flow rate)
+the interpolation table is rebuilt when a measurement is added, a lookup is a single np.interp
+'''
+import json
+import os
+import numpy as np
+
+CALIBRATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pump_calibration.json')
+
+
+class Calibration:
+    """
+    microsteps/mL of a pump as a function of the flow rate [µL/min]
+    measurements at the same rate are pooled, between rates the microsteps/mL are interpolated linearly
+    over log(rate), outside the measured range the nearest measured rate is used
+    """
+
+    def __init__(self, name, default=None, path=CALIBRATION_FILE):
+        """
+        :param name: str, identifies the pump in the calibration file, e.g. 'pump'
+        :param default: float, microsteps/mL used before the first measurement
+        :param path: str, JSON file with the measurements of all pumps
+        """
+        self.name = name
+        self.default = default
+        self.path = path
+        self.points = []  # [rate µL/min, microsteps, volume mL]
+        self._rates = np.empty(0)  # log10 of the measured rates, ascending
+        self._spm = np.empty(0)  # microsteps/mL at those rates
+        self.load()
+
+    def load(self):
+        """ reads the measurements of the pump from the calibration file, if there are any
+        """
+        try:
+            with open(self.path) as f:
+                self.points = json.load(f).get(self.name, [])
+        except (OSError, ValueError):
+            self.points = []
+        self._build()
+
+    def save(self):
+        """ stores the measurements of the pump, keeping those of the other pumps
+        """
+        try:
+            with open(self.path) as f:
+                points = json.load(f)
+        except (OSError, ValueError):
+            points = {}
+        points[self.name] = self.points
+        with open(self.path, 'w') as f:
+            json.dump(points, f, indent=2)
+
+    def record(self, rate, steps, volume, save=True):
+        """ adds a measurement: volume [mL] delivered by steps [microsteps] commanded at rate [µL/min]
+        """
+        if rate == 0 or steps == 0 or volume == 0:
+            raise ValueError('rate, steps and volume must not be 0')
+        self.points.append([abs(rate), abs(steps), abs(volume)])
+        self._build()
+        if save:
+            self.save()
+
+    def clear(self, save=True):
+        """ forgets all measurements of the pump
+        """
+        self.points = []
+        self._build()
+        if save:
+            self.save()
+
+    def _build(self):
+        if not self.points:
+            self._rates, self._spm = np.empty(0), np.empty(0)
+            return
+        p = np.asarray(self.points, dtype=float)
+        rates, index = np.unique(p[:, 0], return_inverse=True)
+        steps = np.bincount(index, weights=p[:, 1])
+        volume = np.bincount(index, weights=p[:, 2])
+        self._rates = np.log10(rates)
+        self._spm = steps / volume
+
+    def steps_per_ml(self, rate):
+        """ returns the microsteps/mL at rate [µL/min], rate may be an array
+        """
+        if not len(self._spm):
+            if self.default is None:
+                raise ValueError(f'pump {self.name} is not calibrated')
+            return np.full(np.shape(rate), float(self.default))[()]
+        return np.interp(np.log10(np.abs(rate)), self._rates, self._spm)[()]
+
+    def steps(self, volume, rate):
+        """ returns the microsteps to command for volume [mL] at rate [µL/min], both may be arrays
+        """
+        return np.rint(np.asarray(volume) * self.steps_per_ml(rate)).astype(np.int64)[()]
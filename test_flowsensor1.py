@@ -1,6 +1,7 @@
 import time
 import conf
 import slf3s_jad
+import flow_acquisition
 
 
 slf3 = slf3s_jad.SLF3S_1300(conf.i2c_flow_sensor,'h2o')
@@ -8,3 +9,16 @@ time.sleep(0.1)
 print(slf3.read_sensor())
 print(slf3.read_flow())
 print(slf3.read_temp())
+
+# continuous acquisition in the background
+acq = flow_acquisition.FlowAcquisition(conf.i2c_flow_sensor)
+acq.start()
+t0 = time.monotonic()
+try:
+    for _ in range(10):
+        time.sleep(0.5)
+        mean, std, lo, hi = acq.stats(0.5)
+        print(f'{acq.count:8d} samples  flow {mean:8.2f} ± {std:6.2f} µL/min  [{lo:8.2f}, {hi:8.2f}]  '
+              f'volume {acq.volume(t0) * 1000:8.3f} µL  CRC errors {acq.errors}')
+finally:
+    acq.stop()
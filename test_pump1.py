@@ -9,7 +9,8 @@ from adafruit_extended_bus import ExtendedSPI as SPIx, ExtendedI2C as I2Cx
 import conf
 
 def pstat(m):
-    print(f'{m.status():08b}  XTARGET {m.reg(tmc.XTARGET):12d}  XACTUAL {m.reg(tmc.XACTUAL):12d}  XLATCH {m.reg(tmc.XLATCH):12d}  RAMP_STAT {m.reg(tmc.RAMP_STAT):013b}')
+    xtarget, xactual, xlatch, ramp_stat = m.pipeline([tmc.XTARGET, tmc.XACTUAL, tmc.XLATCH, tmc.RAMP_STAT])
+    print(f'{m.Status:08b}  XTARGET {xtarget:12d}  XACTUAL {xactual:12d}  XLATCH {xlatch:12d}  RAMP_STAT {ramp_stat:013b}')
 
 
 print(dir(board))
@@ -34,9 +35,9 @@ time.sleep(0.1)
 
 
 try:
-    gconf = 0b100
-    p = tmc.Motor(conf.spi_pump, chip_select=conf.cs_pump, gconf=gconf, ihold_irun=0x01_10_06, num_of_motors=1, motor_num=0,
-                  baudrate=250_000, phase=0, polarity=0)
+    p = tmc.Pump(1_000_000, conf.spi_pump, chip_select=conf.cs_pump, profile='syringe-pump', num_of_motors=1, motor_num=0,
+                 name='pump', phase=0, polarity=0,
+                 baudrate=tmc.load_baudrate('pump', 0, 0, default=250_000))  # 250 kHz until characterized
 
     print(f'{p.status():08b}', p.reg(tmc.XACTUAL))
     print(f'{p.status():08b}', p.moveby(50000, 10000))
@@ -45,6 +46,11 @@ try:
         time.sleep(0.5)
     print(f'{p.status():08b}', p.reg(tmc.XACTUAL))
 
+    job = p.dispense(0.05, 1000)  # 50 µL at 1 mL/min
+    while not job.wait(0.5):
+        print(f'{job.dispensed():.4f} mL dispensed, {job.remaining():.4f} mL to go')
+    print(f'TotalP {p.TotalP:.4f} mL  TotalM {p.TotalM:.4f} mL')
+
 finally:
     conf.cs_pump.switch_to_input()
     conf.cs_pump.deinit()
@@ -0,0 +1,120 @@
+'''
+model of the TMC5130 six-point ramp generator
+predicts the duration and the position vs. time of positioning moves (RAMPMODE=0) from the
+ramp registers VSTART, A1, V1, AMAX, VMAX, DMAX, D1, VSTOP (register units)
+all functions take scalars or NumPy arrays and broadcast over batches of moves
+'''
+import numpy as np
+
+FCLK = 13e6  # the clock frequency, ~13Mhz when using the internal clock
+
+
+def velocity(v, fclk=FCLK):
+    """ converts a velocity from register units to microsteps/s
+    """
+    return np.asarray(v, dtype=float) * fclk / 2**24
+
+
+def acceleration(a, fclk=FCLK):
+    """ converts an acceleration from register units to microsteps/s²
+    """
+    return np.asarray(a, dtype=float) * fclk**2 / (512 * 256) / 2**24
+
+
+def velocity_reg(v, fclk=FCLK):
+    """ converts a velocity from microsteps/s to register units
+    """
+    return np.rint(np.asarray(v, dtype=float) * 2**24 / fclk).astype(np.int64)
+
+
+def acceleration_reg(a, fclk=FCLK):
+    """ converts an acceleration from microsteps/s² to register units
+    """
+    return np.rint(np.asarray(a, dtype=float) * (512 * 256) * 2**24 / fclk**2).astype(np.int64)
+
+
+def _div(a, b):
+    # a / b, 0 where b is 0
+    return np.divide(a, b, out=np.zeros(np.broadcast(a, b).shape), where=b != 0)
+
+
+def profile(distance, vstart=0, a1=0, v1=0, amax=0, vmax=0, dmax=0, d1=0, vstop=10, fclk=FCLK):
+    """ returns (T, X, V, A) describing the ramp of a move from standstill over distance [microsteps]
+        T has shape (..., 6): start times of the five phases (A1, AMAX, cruise, DMAX, D1) and the end time [s]
+        X, V, A have shape (..., 5): position [microsteps], velocity [microsteps/s] and
+        acceleration [microsteps/s²] at the start of each phase, all for a positive distance
+        V1=0 disables the A1/D1 phases like in the TMC5130
+    """
+    d = np.abs(np.asarray(distance, dtype=float))
+    vs = velocity(vstart, fclk)
+    vst = velocity(vstop, fclk)
+    vmx = velocity(vmax, fclk)
+    am = acceleration(amax, fclk)
+    dm = acceleration(dmax, fclk)
+    v1 = velocity(v1, fclk)
+    a1 = np.where(v1 > 0, acceleration(a1, fclk), am)
+    d1 = np.where(v1 > 0, acceleration(d1, fclk), dm)
+    d, vs, vst, vmx, am, dm, v1, a1, d1 = np.broadcast_arrays(d, vs, vst, vmx, am, dm, v1, a1, d1)
+
+    lo = np.maximum(vs, vst)  # the lowest peak velocity the ramp can have
+    vmx = np.maximum(vmx, lo)
+    v1e = np.where(v1 > 0, np.clip(v1, lo, vmx), lo)  # velocity where A1/D1 change to AMAX/DMAX
+
+    # distance needed to ramp up to and down from a peak velocity vp
+    cl = _div(1, 2 * a1) + _div(1, 2 * d1)  # per vp² below V1
+    ch = _div(1, 2 * am) + _div(1, 2 * dm)  # per vp² above V1
+    d_v1 = v1e**2 * cl - vs**2 * _div(1, 2 * a1) - vst**2 * _div(1, 2 * d1)
+    d_vmax = d_v1 + (vmx**2 - v1e**2) * ch
+
+    vp = np.where(d >= d_vmax, vmx,
+                  np.where(d >= d_v1,
+                           np.sqrt(np.maximum(v1e**2 + _div(d - d_v1, ch), 0)),
+                           np.sqrt(np.maximum(_div(d + vs**2 * _div(1, 2 * a1) + vst**2 * _div(1, 2 * d1), cl), 0))))
+    vp = np.clip(vp, lo, vmx)
+    u1 = np.minimum(vp, v1e)
+
+    x_acc1 = _div(u1**2 - vs**2, 2 * a1)
+    x_acc2 = _div(vp**2 - u1**2, 2 * am)
+    x_dec1 = _div(vp**2 - u1**2, 2 * dm)
+    x_dec2 = _div(u1**2 - vst**2, 2 * d1)
+    x_cruise = np.maximum(d - x_acc1 - x_acc2 - x_dec1 - x_dec2, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_cruise = np.where(x_cruise > 0, x_cruise / vp, 0)
+
+    dt = np.stack([_div(u1 - vs, a1), _div(vp - u1, am), t_cruise, _div(vp - u1, dm), _div(u1 - vst, d1)], axis=-1)
+    dx = np.stack([x_acc1, x_acc2, x_cruise, x_dec1, x_dec2], axis=-1)
+    T = np.concatenate([np.zeros(d.shape + (1,)), np.cumsum(dt, axis=-1)], axis=-1)
+    X = np.concatenate([np.zeros(d.shape + (1,)), np.cumsum(dx, axis=-1)[..., :-1]], axis=-1)
+    V = np.stack([vs, u1, vp, vp, u1], axis=-1)
+    A = np.stack([a1, am, np.zeros(d.shape), -dm, -d1], axis=-1)
+    return T, X, V, A
+
+
+def duration(distance, **ramp):
+    """ returns the predicted duration [s] of moves over distance [microsteps] from standstill
+        ramp takes the register values as keyword arguments (vstart, a1, v1, amax, vmax, dmax, d1, vstop, fclk)
+    """
+    return profile(distance, **ramp)[0][..., -1]
+
+
+def position(t, distance, **ramp):
+    """ returns the predicted position [microsteps] relative to the start of a move at the times t [s]
+        t is broadcast along a new last axis, e.g. 4 moves and 100 time points give shape (4, 100)
+    """
+    T, X, V, A = profile(distance, **ramp)
+    t = np.asarray(t, dtype=float)
+    dist = np.broadcast_to(np.asarray(distance, dtype=float), T.shape[:-1])
+    d = T.shape[:-1] + (1,) * t.ndim  # moves first, times last
+    dist = dist.reshape(d)
+    T, X, V, A = T.reshape(d + (6,)), X.reshape(d + (5,)), V.reshape(d + (5,)), A.reshape(d + (5,))
+    shape = np.broadcast_shapes(d, t.shape)
+    tt = np.broadcast_to(t, shape)
+    k = np.clip(np.sum(tt[..., None] >= T[..., :5], axis=-1, keepdims=True) - 1, 0, 4)
+
+    def pick(a):  # value of the phase each time point falls in
+        return np.take_along_axis(np.broadcast_to(a, shape + (5,)), k, -1)[..., 0]
+
+    dt = tt - pick(T[..., :5])
+    x = np.minimum(pick(X) + pick(V) * dt + 0.5 * pick(A) * dt**2, np.abs(dist))
+    x = np.where(tt >= T[..., 5], np.abs(dist), np.where(tt <= 0, 0, x))
+    return np.sign(dist) * x
@@ -0,0 +1,148 @@
+'''
+port sequencing of the rotary MUX valves
+the time of a switch grows with the distance the rotor travels, so the planner takes the shorter way round
+for every switch (see elveflow_mux.ElveflowMux12.port()) and orders the reagent visits of a protocol, where the
+protocol allows it, to minimize the total estimated valve time
+'''
+import itertools
+import elveflow_mux
+
+MAX_GROUP = 8  # visits in a group whose order is optimized exactly, 2^n * n^2 steps per start port
+GROUPS = (list, tuple, set, frozenset)  # items of the visits that may be reordered
+
+
+def _group(cost, starts, group):
+    # returns {end: (time, order)} of the fastest orders of the ports in group from the states in starts
+    # {port: (time, order)}, exactly (Held-Karp) for up to MAX_GROUP ports, else nearest neighbour
+    group = list(group)
+    n = len(group)
+    result = {}
+    for start, (t0, order0) in starts.items():
+        if n > MAX_GROUP:
+            pos, t, order, left = start, t0, list(order0), list(group)
+            while left:
+                nxt = min(left, key=lambda p: cost(pos, p))
+                t += cost(pos, nxt)
+                pos = nxt
+                order.append(nxt)
+                left.remove(nxt)
+            if pos not in result or t < result[pos][0]:
+                result[pos] = (t, order)
+            continue
+        # best[mask][i]: (time, previous index) of visiting the ports in mask, ending at group[i]
+        best = [[None] * n for _ in range(1 << n)]
+        for i, p in enumerate(group):
+            best[1 << i][i] = (t0 + cost(start, p), None)
+        for mask in range(1, 1 << n):
+            for i in range(n):
+                here = best[mask][i]
+                if here is None:
+                    continue
+                for j in range(n):
+                    if mask & 1 << j:
+                        continue
+                    t = here[0] + cost(group[i], group[j])
+                    m = mask | 1 << j
+                    if best[m][j] is None or t < best[m][j][0]:
+                        best[m][j] = (t, i)
+        full = (1 << n) - 1
+        for i in range(n):
+            t = best[full][i][0]
+            if group[i] in result and result[group[i]][0] <= t:
+                continue
+            order, mask, k = [], full, i
+            while k is not None:
+                order.append(group[k])
+                mask, k = mask & ~(1 << k), best[mask][k][1]
+            result[group[i]] = (t, list(order0) + order[::-1])
+    return result
+
+
+def plan(start, visits, cost):
+    """ returns (time, ports): the order of the visits with the lowest total cost from port start
+        visits: list of ports in protocol order, an item that is a list, tuple or set of ports may be visited
+        in any order, e.g. [3, [5, 9, 1], 2] visits 3, then 1, 5 and 9 in the best order, then 2
+        cost(a, b): time [s] of a switch from port a to port b, e.g. ElveflowMux12.move_time
+        start: the port the valve is at, None if unknown (the first switch is then not counted)
+    """
+    states = {start: (0, [])}  # {port the valve ends at: (time, ports visited)}
+
+    def c(a, b):
+        return 0 if a is None else cost(a, b)
+
+    for item in visits:
+        group = item if isinstance(item, GROUPS) else (item,)
+        states = _group(c, states, group)
+    return min(states.values(), key=lambda tv: tv[0])
+
+
+def total(start, ports, cost):
+    """ returns the total cost of visiting ports in the order given, from port start (None: unknown)
+    """
+    t = 0
+    for a, b in zip(itertools.chain([start], ports), ports):
+        if a is not None:
+            t += cost(a, b)
+    return t
+
+
+class Planner:
+    """
+    sequences the reagent visits of a MUX valve
+    """
+
+    def __init__(self, mux):
+        """
+        :param mux: elveflow_mux.ElveflowMux12 object
+        """
+        self.mux = mux
+
+    def plan(self, visits, start=None):
+        """ returns (time, ports): the fastest order of visits from start, the current port by default
+            see plan()
+        """
+        if start is None:
+            start = self.mux.position
+        return plan(start, visits, self.mux.move_time)
+
+    def saving(self, visits, start=None):
+        """ returns the estimated valve time [s] of visits in protocol order, with all moves CCW (the fixed
+            direction of the former driver), in protocol order with the shorter way round, and planned
+        """
+        if start is None:
+            start = self.mux.position
+        ordered = [p for item in visits for p in (item if isinstance(item, GROUPS) else (item,))]
+        mux = self.mux
+
+        def ccw(a, b):
+            return 0 if a == b else mux.t_switch + mux.t_step * ((a - b) % mux.ports)
+
+        return total(start, ordered, ccw), total(start, ordered, mux.move_time), self.plan(visits, start)[0]
+
+    def run(self, visits, callback=None, timeout=10):
+        """ visits the ports in the planned order, the shorter way round, waiting for every move
+            callback(port) is called at each port, e.g. to dispense the reagent, before the next switch
+        """
+        for port in self.plan(visits)[1]:
+            self.mux.port(port, timeout=timeout)
+            if callback:
+                callback(port)
+
+
+if __name__ == '__main__':
+
+    import random
+    import serial
+    import conf
+
+    s = elveflow_mux.ElveflowMux12(serial.Serial(conf.port_selector, baudrate=115200, timeout=1))
+    planner = Planner(s)
+
+    # a multiplex cycle: wash, 4 probes in any order, wash, imaging buffer
+    random.seed(1)
+    visits = []
+    for _ in range(25):
+        visits += [1, random.sample(range(2, 12), 4), 1, 12]
+    print('estimated valve time: CCW only %.1f s, shorter way round %.1f s, planned %.1f s'
+          % planner.saving(visits, start=1))
+    planner.run(visits[:8], callback=lambda port: print('at port', port))